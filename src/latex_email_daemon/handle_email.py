@@ -2,18 +2,22 @@ import sys
 import os
 import json
 import smtplib
+from email import policy
+from email.parser import BytesParser
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from email.message import EmailMessage
+from itertools import chain
 from dotenv import load_dotenv
 
 # ---- Import shared PDF utilities ----
 from pdf_utils import (
-    latex_escape,
     sanitize_filename,
     html_to_latex,
     split_paragraphs,
     split_latex_paragraphs,
     compile_pdf,
 )
+from smtp_pool import SMTPPool
 
 # ---- Load environment variables ----
 load_dotenv()
@@ -28,114 +32,298 @@ EMAIL_BODY_TEXT     = os.getenv(
     "EMAIL_BODY_TEXT",
     "Im Anhang befindet sich die gewünschte PDF.\n\nDies ist eine automatisch generierte Email. Beep. Boop.",
 )
+SMTP_POOL_SIZE      = int(os.getenv("SMTP_POOL_SIZE", 5))
+SMTP_MAX_MESSAGES   = int(os.getenv("SMTP_MAX_MESSAGES_PER_CONNECTION", 100))
 
-if not SENDER_EMAIL or not SENDER_PASSWORD:
-    print("⚠️ SENDER_EMAIL or SENDER_PASSWORD not set in environment")
-    sys.exit(1)
-
-os.makedirs(PDF_DIR, exist_ok=True)
-
-if len(sys.argv) < 2:
-    print("Usage: python handle_email.py <email_json_file>")
-    sys.exit(1)
-
-json_file = sys.argv[1]
-
-try:
-    with open(json_file, "r", encoding="utf-8") as f:
-        data = json.load(f)
-except (FileNotFoundError, json.JSONDecodeError) as e:
-    print(f"⚠️ Failed to load JSON file: {e}")
-    sys.exit(1)
-
-subject_raw  = data.get("subject", "No Subject")
-subject_safe = sanitize_filename(subject_raw)
-
-raw_body = data.get("html") or data.get("text") or ""
-raw_body = raw_body.strip()
-if not raw_body:
-    raw_body = "No body content"
-
-is_html = bool(data.get("html"))
-
-if is_html:
-    latex_body = html_to_latex(raw_body)
-    first_paragraph, second_paragraph, third_paragraph, rest_body = split_latex_paragraphs(latex_body)
-else:
-    first_paragraph, second_paragraph, third_paragraph, rest_body = split_paragraphs(raw_body)
-
-from_email = [email for _, email in data.get("from", [])]
-cc_emails  = [email for _, email in data.get("cc",   [])] if data.get("cc")  else []
-bcc_emails = [email for _, email in data.get("bcc",  [])] if data.get("bcc") else []
-all_recipients = list(set(from_email + cc_emails + bcc_emails))
-
-if not all_recipients:
-    print("⚠️ No recipients found in email")
-    sys.exit(1)
-
-try:
-    pdf_bytes = compile_pdf(
-        template_file=LATEX_TEMPLATE_FILE,
-        subject=subject_raw,
-        first_paragraph=first_paragraph,
-        second_paragraph=second_paragraph,
-        third_paragraph=third_paragraph,
-        body=rest_body,
-    )
-except RuntimeError as e:
-    print(f"⚠️ {e}")
-    sys.exit(1)
-
-def unique_filename(base_name, ext):
+_smtp_pool: SMTPPool | None = None
+
+
+def smtp_pool() -> SMTPPool:
+    """Return the process-wide SMTP pool, creating it on first use."""
+    global _smtp_pool
+    if _smtp_pool is None:
+        _smtp_pool = SMTPPool(
+            SMTP_SERVER, SMTP_PORT, SENDER_EMAIL, SENDER_PASSWORD,
+            size=SMTP_POOL_SIZE, max_messages=SMTP_MAX_MESSAGES,
+        )
+    return _smtp_pool
+
+
+def create_unique_file(base_name, ext):
+    """
+    Create a new file in PDF_DIR named base_name.ext, or base_name_N.ext if
+    that is taken, and return (path, binary file object).
+    """
+    # One directory listing instead of a stat() per candidate name; O_EXCL
+    # makes the claim atomic, so a name another worker process took in the
+    # meantime just moves us on to the next counter.
+    with os.scandir(PDF_DIR) as entries:
+        existing = {entry.name for entry in entries}
     filename = f"{base_name}.{ext}"
     counter = 1
-    while os.path.exists(os.path.join(PDF_DIR, filename)):
+    while True:
+        if filename not in existing:
+            path = os.path.join(PDF_DIR, filename)
+            try:
+                return path, open(path, "xb")
+            except FileExistsError:
+                pass
         filename = f"{base_name}_{counter}.{ext}"
         counter += 1
-    return os.path.join(PDF_DIR, filename)
-
-pdf_file = unique_filename(subject_safe, "pdf")
-
-try:
-    with open(pdf_file, "wb") as f:
-        f.write(pdf_bytes)
-    print(f"✅ PDF generated: {pdf_file}")
-except IOError as e:
-    print(f"⚠️ Failed to write PDF: {e}")
-    sys.exit(1)
-
-msg = EmailMessage()
-msg["Subject"] = f"PDF: {subject_raw}"
-msg["From"]    = SENDER_EMAIL
-msg["To"]      = ", ".join(all_recipients)
-msg.set_content(EMAIL_BODY_TEXT)
-msg.add_attachment(pdf_bytes, maintype="application", subtype="pdf",
-                   filename=os.path.basename(pdf_file))
-
-try:
-    with smtplib.SMTP(SMTP_SERVER, SMTP_PORT, timeout=30) as server:
-        server.starttls()
+
+
+def _remove(path: str) -> bool:
+    """Delete *path* with a single unlink; False if it was already gone."""
+    try:
+        os.remove(path)
+        return True
+    except FileNotFoundError:
+        return False
+
+
+def _addresses(msg, header: str) -> list[tuple[str, str]]:
+    return [(a.display_name, a.addr_spec) for h in msg.get_all(header, []) for a in h.addresses]
+
+
+def _part_text(part) -> str | None:
+    if part is None:
+        return None
+    try:
+        return part.get_content()
+    except (LookupError, ValueError):
+        # Unknown or bogus charset: fall back to lenient UTF-8.
+        return (part.get_payload(decode=True) or b"").decode("utf-8", errors="replace")
+
+
+def read_eml(eml_file: str) -> dict:
+    """Parse a raw RFC822 file saved by the daemon into the fields load_job needs."""
+    with open(eml_file, "rb") as f:
+        msg = BytesParser(policy=policy.default).parse(f)
+    return {
+        "subject": str(msg.get("subject", "")),
+        "from": _addresses(msg, "from"),
+        "cc": _addresses(msg, "cc"),
+        "bcc": _addresses(msg, "bcc"),
+        "text": _part_text(msg.get_body(preferencelist=("plain",))),
+        "html": _part_text(msg.get_body(preferencelist=("html",))),
+    }
+
+
+def load_job(job_file: str) -> dict | None:
+    """
+    Read a saved email and prepare everything needed to render and send it.
+    *job_file* is a raw ``.eml`` from the daemon (with an optional
+    ``.meta.json`` sidecar) or a JSON file in the older format.
+    """
+    if job_file.endswith(".eml"):
+        files = [job_file, job_file[:-len(".eml")] + ".meta.json"]
+        try:
+            data = read_eml(job_file)
+        except OSError as e:
+            print(f"⚠️ Failed to load email file: {e}")
+            return None
+    else:
+        files = [job_file]
         try:
-            server.login(SENDER_EMAIL, SENDER_PASSWORD)
-        except smtplib.SMTPAuthenticationError as e:
-            print("⚠️ Authentication failed.")
-            print(f"Server response: {e}")
-            sys.exit(1)
-        server.send_message(msg)
-    print(f"📤 Email sent to: {all_recipients}")
-
-    if os.path.exists(json_file):
-        os.remove(json_file)
-        print(f"🗑 Deleted JSON file: {json_file}")
-    if os.path.exists(pdf_file):
-        os.remove(pdf_file)
-    print("🗑 Cleaned up PDF")
-
-except smtplib.SMTPException as e:
-    print(f"⚠️ SMTP error: {e}")
-    sys.exit(1)
-except Exception as e:
-    print(f"⚠️ Failed to send email: {e}")
-    import traceback
-    traceback.print_exc()
-    sys.exit(1)
+            with open(job_file, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError) as e:
+            print(f"⚠️ Failed to load JSON file: {e}")
+            return None
+
+    subject_raw = data.get("subject", "No Subject")
+
+    raw_body = data.get("html") or data.get("text") or ""
+    raw_body = raw_body.strip()
+    if not raw_body:
+        raw_body = "No body content"
+
+    is_html = bool(data.get("html"))
+
+    if is_html:
+        latex_body = html_to_latex(raw_body)
+        first_paragraph, second_paragraph, third_paragraph, rest_body = split_latex_paragraphs(latex_body)
+    else:
+        first_paragraph, second_paragraph, third_paragraph, rest_body = split_paragraphs(raw_body)
+
+    from_email = [email for _, email in data.get("from", [])]
+    cc_emails  = [email for _, email in data.get("cc",   [])] if data.get("cc")  else []
+    bcc_emails = [email for _, email in data.get("bcc",  [])] if data.get("bcc") else []
+    all_recipients = list(dict.fromkeys(chain(from_email, cc_emails, bcc_emails)))
+
+    if not all_recipients:
+        print("⚠️ No recipients found in email")
+        return None
+
+    return {
+        "files": files,
+        "subject": subject_raw,
+        "recipients": all_recipients,
+        "fields": {
+            "subject": subject_raw,
+            "first_paragraph": first_paragraph,
+            "second_paragraph": second_paragraph,
+            "third_paragraph": third_paragraph,
+            "body": rest_body,
+        },
+    }
+
+
+def render(job: dict) -> bytes:
+    """Compile the PDF for *job*. Runs in worker processes when batching."""
+    return compile_pdf(template_file=LATEX_TEMPLATE_FILE, **job["fields"])
+
+
+def _keep_pdf(subject: str, pdf_bytes: bytes) -> None:
+    """Persist the PDF of a failed delivery in PDF_DIR for debugging."""
+    try:
+        os.makedirs(PDF_DIR, exist_ok=True)
+        pdf_file, f = create_unique_file(sanitize_filename(subject), "pdf")
+        with f:
+            f.write(pdf_bytes)
+        print(f"💾 PDF kept for debugging: {pdf_file}")
+    except OSError as e:
+        print(f"⚠️ Failed to write PDF: {e}")
+
+
+def deliver(job: dict, pdf_bytes: bytes) -> int:
+    """Mail *pdf_bytes* back to the job's recipients. Returns an exit code."""
+    subject_raw = job["subject"]
+    all_recipients = job["recipients"]
+    print(f"✅ PDF generated ({len(pdf_bytes)} bytes)")
+
+    msg = EmailMessage()
+    msg["Subject"] = f"PDF: {subject_raw}"
+    msg["From"]    = SENDER_EMAIL
+    msg["To"]      = ", ".join(all_recipients)
+    msg.set_content(EMAIL_BODY_TEXT)
+    # A memoryview lets the base64 encoder slice the PDF without copying it.
+    msg.add_attachment(memoryview(pdf_bytes), maintype="application", subtype="pdf",
+                       filename=f"{sanitize_filename(subject_raw)}.pdf")
+
+    try:
+        with smtp_pool().acquire() as conn:
+            conn.send_message(msg)
+        print(f"📤 Email sent to: {all_recipients}")
+
+        for path in job["files"]:
+            if _remove(path):
+                print(f"🗑 Deleted job file: {path}")
+
+    except smtplib.SMTPAuthenticationError as e:
+        print("⚠️ Authentication failed.")
+        print(f"Server response: {e}")
+        _keep_pdf(subject_raw, pdf_bytes)
+        return 1
+    except smtplib.SMTPException as e:
+        print(f"⚠️ SMTP error: {e}")
+        _keep_pdf(subject_raw, pdf_bytes)
+        return 1
+    except Exception as e:
+        print(f"⚠️ Failed to send email: {e}")
+        import traceback
+        traceback.print_exc()
+        _keep_pdf(subject_raw, pdf_bytes)
+        return 1
+
+    return 0
+
+
+def _config_ok() -> bool:
+    if not SENDER_EMAIL or not SENDER_PASSWORD:
+        print("⚠️ SENDER_EMAIL or SENDER_PASSWORD not set in environment")
+        return False
+    return True
+
+
+def process(job_file: str) -> int:
+    """Turn one saved email into a PDF and mail it back. Returns an exit code."""
+    if not _config_ok():
+        return 1
+    job = load_job(job_file)
+    if job is None:
+        return 1
+    try:
+        pdf_bytes = render(job)
+    except RuntimeError as e:
+        print(f"⚠️ {e}")
+        return 1
+    return deliver(job, pdf_bytes)
+
+
+def process_batch(job_files: list[str]) -> int:
+    """
+    Process several jobs, compiling their PDFs in parallel.
+
+    pdflatex is single-threaded, so compilations are spread over one worker
+    process per CPU. Each finished PDF is handed to a sender thread right
+    away; SMTP is network-bound, so up to SMTP_POOL_SIZE sends overlap with
+    each other and with the remaining compilations.
+    """
+    if len(job_files) == 1:
+        return process(job_files[0])
+
+    exit_code = 0
+    jobs = []
+    for job_file in job_files:
+        job = load_job(job_file)
+        if job is None:
+            exit_code = 1
+        else:
+            jobs.append(job)
+    if not jobs:
+        return exit_code
+
+    workers = min(len(jobs), os.cpu_count() or 1)
+    with (
+        ProcessPoolExecutor(max_workers=workers) as compilers,
+        ThreadPoolExecutor(max_workers=SMTP_POOL_SIZE) as senders,
+    ):
+        futures = {compilers.submit(render, job): job for job in jobs}
+        sends = []
+        for future in as_completed(futures):
+            try:
+                pdf_bytes = future.result()
+            except RuntimeError as e:
+                print(f"⚠️ {e}")
+                exit_code = 1
+                continue
+            sends.append(senders.submit(deliver, futures[future], pdf_bytes))
+        for send in sends:
+            exit_code = send.result() or exit_code
+    return exit_code
+
+
+def collect_jobs(paths: list[str]) -> list[str]:
+    """Expand directories in *paths* to the saved emails they contain."""
+    jobs = []
+    for path in paths:
+        if os.path.isdir(path):
+            jobs.extend(
+                os.path.join(path, name)
+                for name in sorted(os.listdir(path))
+                if name.endswith(".eml")
+                or (name.endswith(".json") and not name.endswith(".meta.json"))
+            )
+        else:
+            jobs.append(path)
+    return jobs
+
+
+def main(argv: list[str]) -> int:
+    if not _config_ok():
+        return 1
+
+    if len(argv) < 2:
+        print("Usage: python handle_email.py <email_file|job_dir> [...]")
+        return 1
+
+    try:
+        exit_code = process_batch(collect_jobs(argv[1:]))
+    finally:
+        smtp_pool().close()
+    return exit_code
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,52 @@
+"""
+handler_worker.py — Entry points for the daemon's handler worker processes.
+
+The daemon (main.py) runs handle_email.process() in a process pool.  The
+pool functions live here rather than in main.py so that workers only need
+this module and the handler, never the IMAP daemon itself.
+
+Each job is timed inside the worker: the clock starts when a worker picks
+the job up (not while it waits in the pool's queue) and SIGALRM aborts it
+once the timeout is reached.  The start time is reported back to the
+daemon, which replaces the whole pool if a worker ignores the alarm.
+"""
+
+import signal
+import time
+
+_started = None  # multiprocessing queue of (uid, monotonic start time)
+
+
+class HandlerTimeout(BaseException):
+    """
+    Raised inside a worker when a job runs past its timeout.  Like
+    KeyboardInterrupt it is not an Exception, so the handler's own error
+    handling (e.g. keeping a debug PDF after a failed send) cannot swallow it.
+    """
+
+
+def _on_alarm(signum, frame):
+    raise HandlerTimeout("handler timed out")
+
+
+def init(started) -> None:
+    global _started
+    _started = started
+    # Workers finish their current job on Ctrl-C; the daemon drains them.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGALRM, _on_alarm)
+    # Pay for importing the handler (and pdf_utils) once per worker.
+    import handle_email
+    # A worker sends one email at a time; more than one SMTP session per
+    # worker would only sit idle and count against the provider's limit.
+    handle_email.SMTP_POOL_SIZE = 1
+
+
+def run(uid: int, eml_path: str, timeout: int) -> int:
+    import handle_email
+    _started.put((uid, time.monotonic()))
+    signal.alarm(timeout)
+    try:
+        return handle_email.process(eml_path)
+    finally:
+        signal.alarm(0)
@@ -1,16 +1,31 @@
+import base64
+import functools
+import hashlib
 import os
 import time
 import signal
+import ssl
 import sys
 import json
-import subprocess
+import mmap
+import multiprocessing
+import queue
+import quopri
+import threading
+import traceback
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
 from datetime import datetime
-from typing import List
+from itertools import batched
+from email.parser import BytesHeaderParser
+from email.utils import getaddresses
+from typing import List, Sequence
 
 from imapclient import IMAPClient
-import pyzmail
 from dotenv import load_dotenv
 
+import handler_worker
+
 # ---- Load .env ----
 load_dotenv()
 
@@ -23,13 +38,24 @@ ALLOWED_SENDER_DOMAIN = os.getenv("ALLOWED_SENDER_DOMAIN", "")
 IDLE_TIMEOUT = int(os.getenv("IDLE_TIMEOUT", 300))
 STATE_FILE = os.getenv("STATE_FILE", "last_seen_uid.txt")
 JSON_DIR = os.getenv("JSON_DIR", "emails")
-FETCH_BATCH_SIZE = 100  # messages per batch
-
-required_vars = [IMAP_SERVER, EMAIL_ACCOUNT, EMAIL_PASSWORD, TARGET_ADDRESS]
-if not all(required_vars):
-    raise RuntimeError("Missing required environment variables")
-
-os.makedirs(JSON_DIR, exist_ok=True)
+JOURNAL_FILE = "journal.jsonl"  # inside JSON_DIR
+FETCH_BATCH_SIZE = 100  # full messages per batch
+HEADER_FETCH_MAX = FETCH_BATCH_SIZE * 10  # UIDs per header FETCH; keeps the command line bounded
+# Only the headers needed to decide whether a message is for us; BODY.PEEK
+# leaves the \Seen flag alone, just like the RFC822 fetch of matches.
+HEADER_FETCH = b"BODY.PEEK[HEADER.FIELDS (FROM TO)]"
+HANDLER_WORKERS = int(os.getenv("HANDLER_WORKERS", 4))
+HANDLER_TIMEOUT = 120  # seconds one PDF may take to be generated and sent, timed in the worker
+HANDLER_KILL_GRACE = 10  # extra seconds before a worker that ignored its timeout is killed
+HANDLER_POLL_INTERVAL = 5  # IDLE timeout while handler jobs are still running
+
+# Filter values normalised once instead of for every message
+TARGET_ADDRESS_LC = (TARGET_ADDRESS or "").lower()
+ALLOWED_SUFFIXES = (f"@{ALLOWED_SENDER_DOMAIN.lower()}",) if ALLOWED_SENDER_DOMAIN else ()
+
+# Saved emails are created relative to this descriptor, so JSON_DIR is
+# resolved once instead of on every open/rename. Opened in setup().
+JSON_DIR_FD = None
 
 shutdown_requested = False
 
@@ -39,239 +65,632 @@ def request_shutdown(signum, frame):
     shutdown_requested = True
     print(f"\n🛑 Shutdown requested (signal {signum}). Finishing current work…")
 
-signal.signal(signal.SIGINT, request_shutdown)
-signal.signal(signal.SIGTERM, request_shutdown)
+# ---- handler workers ----
+# Workers are forked from a small single-threaded server process, never
+# from the daemon itself, which runs the IMAP prefetch thread. The server
+# imports this module (now free of side effects) and the handler once, so
+# every worker starts with them loaded.
+_MP_CONTEXT = multiprocessing.get_context("forkserver")
+_MP_CONTEXT.set_forkserver_preload(["__main__", "handler_worker", "handle_email"])
+
+EXECUTOR: ProcessPoolExecutor | None = None
+# Workers report (uid, start time) here when they pick a job up; replaced
+# together with the pool, since a killed worker may leave it locked.
+_STARTED = None
+
+def start_handler_pool() -> None:
+    global EXECUTOR, _STARTED
+    _STARTED = _MP_CONTEXT.Queue()
+    EXECUTOR = ProcessPoolExecutor(
+        max_workers=HANDLER_WORKERS,
+        mp_context=_MP_CONTEXT,
+        initializer=handler_worker.init,
+        initargs=(_STARTED,),
+    )
+
+def restart_handler_pool() -> None:
+    """Kill every worker, including any stuck in a job, and start a fresh pool."""
+    # ProcessPoolExecutor has no public way to stop a running job (before 3.14).
+    for process in list((EXECUTOR._processes or {}).values()):
+        process.kill()
+    # Jobs still queued in the old pool fail with BrokenProcessPool and are resubmitted.
+    EXECUTOR.shutdown(wait=False)
+    start_handler_pool()
+
+def submit_handler(uid: int, eml_path: str):
+    """Queue a saved email for the handler pool, replacing the pool if a worker died."""
+    try:
+        return EXECUTOR.submit(handler_worker.run, uid, eml_path, HANDLER_TIMEOUT)
+    except BrokenProcessPool:
+        print("⚠️ Handler pool broken, restarting workers")
+        start_handler_pool()
+        return EXECUTOR.submit(handler_worker.run, uid, eml_path, HANDLER_TIMEOUT)
+
+def finish_handler(uid: int, future) -> bool:
+    """Report a finished handler job; True if the PDF was generated and sent."""
+    try:
+        exit_code = future.result()
+    except handler_worker.HandlerTimeout:
+        print(f"⚠️ Handler timed out for UID {uid}")
+        return False
+    except Exception as e:
+        print(f"⚠️ Handler crashed for UID {uid}: {e}")
+        return False
+
+    if exit_code == 0:
+        print(f"⚡ Successfully processed UID {uid}")
+        return True
+    print(f"⚠️ Handler failed with code {exit_code}")
+    # Don't delete the saved email on failure for debugging
+    return False
+
+class PendingJobs:
+    """
+    Handler jobs that were submitted but not reaped yet, keyed by UID.
+    Lets the daemon go back to IDLE while PDFs are still being generated;
+    the state file never moves past the oldest unfinished job.
+    """
+
+    def __init__(self):
+        self._jobs = {}  # uid -> [future, eml path, start time reported by the worker, retried]
+        self._saved_uid = None
+
+    def __len__(self):
+        return len(self._jobs)
+
+    def __contains__(self, uid):
+        return uid in self._jobs
+
+    def add(self, uid: int, eml_path: str) -> None:
+        self._jobs[uid] = [submit_handler(uid, eml_path), eml_path, None, False]
+
+    def _note_started(self) -> None:
+        while True:
+            try:
+                uid, started = _STARTED.get_nowait()
+            except queue.Empty:
+                return
+            if uid in self._jobs:
+                self._jobs[uid][2] = started
+
+    def reap(self) -> List[int]:
+        """Collect finished jobs without blocking; returns the UIDs that succeeded."""
+        self._note_started()
+        now = time.monotonic()
+        succeeded = []
+        stuck = False
+        for uid, job in list(self._jobs.items()):
+            future, eml_path, started, retried = job
+            if not future.done():
+                # The worker's own alarm ends a job at HANDLER_TIMEOUT; past
+                # the grace period the worker is stuck and has to be killed.
+                if started is not None and now - started > HANDLER_TIMEOUT + HANDLER_KILL_GRACE:
+                    print(f"⚠️ Handler timed out for UID {uid}, restarting workers")
+                    del self._jobs[uid]
+                    stuck = True
+                continue
+            if isinstance(future.exception(), BrokenProcessPool) and not retried:
+                # Lost with a dead worker (possibly one we killed); try once more.
+                print(f"🔁 Resubmitting UID {uid} after a worker died")
+                self._jobs[uid] = [submit_handler(uid, eml_path), eml_path, None, True]
+                continue
+            del self._jobs[uid]
+            if finish_handler(uid, future):
+                succeeded.append(uid)
+        if stuck:
+            restart_handler_pool()
+            # Start times from the killed pool no longer mean anything.
+            for job in self._jobs.values():
+                job[2] = None
+        return succeeded
+
+    def drain(self) -> List[int]:
+        """Wait for every job (used on shutdown); returns the UIDs that succeeded."""
+        succeeded = []
+        while self._jobs:
+            futures = [future for future, *_ in self._jobs.values()]
+            wait(futures, timeout=HANDLER_POLL_INTERVAL, return_when=FIRST_COMPLETED)
+            succeeded += self.reap()
+        return succeeded
+
+    def commit_state(self, scanned_uid: int) -> int:
+        """Save the highest UID below every unfinished job, if it changed."""
+        uid = min(scanned_uid, min(self._jobs) - 1) if self._jobs else scanned_uid
+        if uid != self._saved_uid:
+            save_state(uid)
+            self._saved_uid = uid
+        return uid
+
+def delete_processed(server: IMAPClient, uids: List[int]) -> bool:
+    """
+    Delete the original emails from the inbox now that their PDFs were sent.
+    Returns True if anything was expunged.
+    """
+    if not uids:
+        return False
+    try:
+        server.delete_messages(uids)
+        server.expunge()
+        print(f"🗑 Deleted UID(s) {uids} from inbox")
+        return True
+    except Exception as del_err:
+        print(f"⚠️ Could not delete UID(s) {uids} from inbox: {del_err}")
+        return False
 
 # ---- state persistence ----
+# last_seen_uid lives in a fixed-width slot of a memory-mapped STATE_FILE:
+# saving it is one store into the page plus msync, no temp file or rename.
+_STATE_SLOT = 32
+_state_map = None
+
+def _state_slot() -> mmap.mmap:
+    global _state_map
+    if _state_map is None:
+        fd = os.open(STATE_FILE, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            # Older state files hold just the digits; padding them with
+            # NULs keeps the value readable.
+            if os.fstat(fd).st_size != _STATE_SLOT:
+                os.ftruncate(fd, _STATE_SLOT)
+            _state_map = mmap.mmap(fd, _STATE_SLOT)
+        finally:
+            os.close(fd)
+    return _state_map
+
 def load_state():
     try:
-        with open(STATE_FILE, "r") as f:
-            value = f.read().strip()
-            return int(value) if value else 0
+        value = _state_slot()[:].rstrip(b"\0").strip()
+        return int(value) if value else 0
     except Exception:
         return 0
 
 def save_state(last_uid):
-    tmp = STATE_FILE + ".tmp"
-    with open(tmp, "w") as f:
-        f.write(str(last_uid))
-    os.replace(tmp, STATE_FILE)
+    slot = _state_slot()
+    slot[:] = f"{last_uid:<{_STATE_SLOT - 1}d}\n".encode()
+    slot.flush()
 
 # ---- helpers ----
-def connect() -> IMAPClient:
+def connect(ssl_context: ssl.SSLContext | None = None):
+    """Log in and select INBOX; returns the client and the SELECT response."""
     print("🔌 Connecting to Gmail…")
-    server = IMAPClient(IMAP_SERVER, ssl=True)
+    server = IMAPClient(IMAP_SERVER, ssl=True, ssl_context=ssl_context)
     server.login(EMAIL_ACCOUNT, EMAIL_PASSWORD)
-    server.select_folder("INBOX")
+    select_info = server.select_folder("INBOX")
     print("📬 Connected to INBOX")
-    return server
-
-def chunked(items: List[int], size: int):
-    for i in range(0, len(items), size):
-        yield items[i:i+size]
-
-def decode_payload(part, charset="utf-8"):
-    """Safely decode email part payload."""
+    return server, select_info
+
+class ConnectionHolder:
+    """
+    Keeps one logged-in IMAP session across errors. get() hands out the
+    current connection if it still answers NOOP and only pays for a new
+    TLS handshake + login when the session is really gone.
+    """
+
+    def __init__(self):
+        self.server: IMAPClient | None = None
+        self.select_info: dict = {}  # SELECT response of the current session
+        # Certificates are loaded once, not on every reconnect.
+        self.ssl_context = ssl.create_default_context()
+
+    def get(self) -> IMAPClient:
+        if self.server is not None:
+            try:
+                self.server.noop()
+                return self.server
+            except Exception:
+                print("🔌 IMAP session lost")
+                self.close()
+        self.server, self.select_info = connect(self.ssl_context)
+        return self.server
+
+    def close(self) -> None:
+        if self.server is None:
+            return
+        try:
+            self.server.logout()
+        except Exception:
+            try:
+                self.server.shutdown()
+            except Exception:
+                pass
+        self.server = None
+
+def sequence_set(uids: Sequence[int]) -> str:
+    """Compact IMAP sequence set for sorted *uids*, e.g. [3, 4, 5, 9] -> "3:5,9"."""
+    ranges = []
+    start = prev = uids[0]
+    for uid in uids[1:]:
+        if uid != prev + 1:
+            ranges.append(f"{start}:{prev}" if start != prev else str(start))
+            start = uid
+        prev = uid
+    ranges.append(f"{start}:{prev}" if start != prev else str(start))
+    return ",".join(ranges)
+
+def has_new_mail(responses) -> bool:
+    """True if IDLE pushed an EXISTS; flag changes and EXPUNGEs need no search."""
+    return any(len(r) > 1 and r[1] == b"EXISTS" for r in responses)
+
+_header_parser = BytesHeaderParser()
+
+def _make_accept():
+    """
+    Build the TO/sender-domain filter once for the configured values, so the
+    per-message check has no config lookups and no branch on an empty
+    ALLOWED_SENDER_DOMAIN. Both arguments are lists of lowercased addresses.
+    """
+    target = TARGET_ADDRESS_LC
+    suffixes = ALLOWED_SUFFIXES
+    if not suffixes:
+        def accept(from_emails, to_emails):
+            return target in to_emails
+    else:
+        def accept(from_emails, to_emails):
+            return target in to_emails and any(email.endswith(suffixes) for email in from_emails)
+    return accept
+
+accept = _make_accept()
+
+def is_wanted(uid: int, data) -> bool:
+    """Apply the TO/sender-domain filter to a header-only FETCH result."""
+    # The response key echoes the section without ".PEEK", so don't spell it out.
+    raw = next((v for k, v in (data or {}).items() if k.startswith(b"BODY[")), None)
+    if raw is None:
+        print(f"⚠️ No headers returned for UID {uid}")
+        return False
+    headers = _header_parser.parsebytes(raw)
+
+    to_emails = [email.lower() for _, email in getaddresses(headers.get_all("to", []))]
+    from_emails = [email.lower() for _, email in getaddresses(headers.get_all("from", []))]
+    if accept(from_emails, to_emails):
+        return True
+
+    # Only the slow path works out why, for the log
+    if TARGET_ADDRESS_LC in to_emails:
+        print(f"❌ Ignored email from disallowed domain: {from_emails}")
+    return False
+
+@functools.cache
+def _load_pyzmail():
+    """Import pyzmail on the first matching email, not at daemon start."""
+    import pyzmail
+    return pyzmail.PyzMessage.factory
+
+def decode_head(part, n=256):
+    """
+    Decode about the first *n* bytes of an email part for a preview, undoing
+    only as much of the transfer encoding as that needs.
+    """
     if not part:
         return None
     try:
-        payload = part.get_payload()
-        if isinstance(payload, bytes):
-            return payload.decode(charset, errors="replace")
-        return str(payload)
+        msg = part.part  # the underlying email.message.Message
+        cte = str(msg.get("content-transfer-encoding", "")).strip().lower()
+        if cte == "base64":
+            head = "".join(msg.get_payload()[:2 * n].split())
+            data = base64.b64decode(head[:len(head) // 4 * 4])
+        elif cte == "quoted-printable":
+            data = quopri.decodestring(msg.get_payload()[:3 * n].encode("utf-8", "surrogateescape"))
+        else:
+            # Nothing to undo: the raw bytes, still in the part's charset (the
+            # str payload of an 8bit part would already be decoded).
+            data = msg.get_payload(decode=True)
+        return data[:n].decode(part.charset or "utf-8", errors="replace")
     except Exception as e:
         print(f"⚠️ Failed to decode payload: {e}")
         return None
 
-def save_email_json(full_msg, uid):
+def write_file_atomic(name: str, data: bytes) -> None:
+    """
+    Write *data* to *name* in JSON_DIR with one write() call on a fresh temp
+    file, fsync it and rename it into place, so readers never see a partial file.
+    """
+    tmp = name + ".tmp"
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644, dir_fd=JSON_DIR_FD)
+    try:
+        view = memoryview(data)
+        while view:
+            view = view[os.write(fd, view):]
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+    os.replace(tmp, name, src_dir_fd=JSON_DIR_FD, dst_dir_fd=JSON_DIR_FD)
+
+def append_journal(uid: int, path: str, raw: bytes) -> None:
+    """
+    Record a saved email as one line of JSON_DIR/JOURNAL_FILE, so tools can tail the
+    journal instead of listing and stat()ing JSON_DIR.
+    """
+    entry = {
+        "uid": uid,
+        "path": path,
+        "ts": datetime.now().isoformat(timespec="seconds"),
+        "sha256": hashlib.sha256(raw).hexdigest(),
+    }
+    opener = functools.partial(os.open, dir_fd=JSON_DIR_FD)
+    with open(JOURNAL_FILE, "a", encoding="utf-8", buffering=1, opener=opener) as f:
+        f.write(json.dumps(entry, separators=(",", ":")) + "\n")
+
+def save_email(raw: bytes, full_msg, uid):
+    """
+    Store the untouched RFC822 source for the handler, which parses it once
+    itself, plus a small .meta.json sidecar for humans, and journal it.
+    """
     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    filename = f"{timestamp}_{uid}.json"
-    path = os.path.join(JSON_DIR, filename)
+    base = f"{timestamp}_{uid}"
+    write_file_atomic(base + ".eml", raw)
 
-    # Decode text and HTML parts properly
-    body_text = decode_payload(
-        full_msg.text_part,
-        full_msg.text_part.charset or "utf-8"
-    ) if full_msg.text_part else None
-
-    body_html = decode_payload(
-        full_msg.html_part,
-        full_msg.html_part.charset or "utf-8"
-    ) if full_msg.html_part else None
-
-    data = {
+    meta = {
         "uid": uid,
         "subject": full_msg.get_subject(),
         "from": full_msg.get_addresses("from"),
-        "to": full_msg.get_addresses("to"),
-        "cc": full_msg.get_addresses("cc") or [],
-        "bcc": full_msg.get_addresses("bcc") or [],
-        "text": body_text,
-        "html": body_html
+        "text_snippet": decode_head(full_msg.text_part),
+        "html_snippet": decode_head(full_msg.html_part),
     }
-
-    with open(path, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
-
-    return path, body_text, body_html
+    write_file_atomic(
+        base + ".meta.json",
+        json.dumps(meta, ensure_ascii=False, separators=(",", ":")).encode("utf-8"),
+    )
+    # The handler runs in another process and needs the full path.
+    path = os.path.join(JSON_DIR, base + ".eml")
+    append_journal(uid, path, raw)
+
+    return path, meta
+
+
+def fetch_batches(server: IMAPClient, uids: List[int], stop: threading.Event):
+    """
+    Yield (upto_uid, keep_uids, messages) per batch of full messages, where
+    every UID up to upto_uid is either in keep_uids or was filtered out.
+    """
+    batch_num = 0
+    for header_batch in batched(uids, HEADER_FETCH_MAX):
+        if shutdown_requested or stop.is_set():
+            print("🛑 Shutdown detected before batch fetch")
+            return
+        # Triage on headers only, in one round-trip for up to HEADER_FETCH_MAX UIDs
+        headers = server.fetch(sequence_set(header_batch), [HEADER_FETCH])
+        keep_uids = [uid for uid in header_batch if is_wanted(uid, headers.get(uid))]
+        if not keep_uids:
+            yield header_batch[-1], [], {}
+            continue
+
+        # Full messages just for matches, in batches so memory stays bounded
+        body_batches = list(batched(keep_uids, FETCH_BATCH_SIZE))
+        for i, uid_batch in enumerate(body_batches):
+            if shutdown_requested or stop.is_set():
+                print("🛑 Shutdown detected before batch fetch")
+                return
+            batch_num += 1
+            print(f"📦 Fetching batch {batch_num} ({len(uid_batch)} messages)")
+            messages = server.fetch(sequence_set(uid_batch), ["RFC822"])
+            upto_uid = header_batch[-1] if i == len(body_batches) - 1 else uid_batch[-1]
+            yield upto_uid, uid_batch, messages
+
+
+def prefetch_batches(server: IMAPClient, uids: List[int], out: queue.Queue, stop: threading.Event):
+    """
+    Producer thread: fetch batch i+1 while the caller is still working on
+    batch i. This is the only thread talking to *server* until it returns.
+    Puts (None, batch) per batch from fetch_batches, then (None, None);
+    an exception ends the stream as (exc, None).
+    """
+    try:
+        for batch in fetch_batches(server, uids, stop):
+            out.put((None, batch))
+    except Exception as e:
+        out.put((e, None))
+    else:
+        out.put((None, None))
 
 
-def process_new_messages(server: IMAPClient, last_seen_uid: int) -> int:
+def process_new_messages(server: IMAPClient, last_seen_uid: int, jobs: PendingJobs) -> int:
+    """
+    Hand every new matching email to the handler pool. Returns the highest
+    UID looked at; jobs still running stay in *jobs* and are reaped later.
+    """
     search_range = f"{last_seen_uid + 1}:*"
-    uids = [uid for uid in server.search(["UID", search_range]) if uid > last_seen_uid]
-    if not uids:
+    # "n:*" always includes the newest message, even if its UID is below n.
+    new_uids = [uid for uid in server.search(["UID", search_range]) if uid > last_seen_uid]
+    if not new_uids:
         print("📭 No new messages")
         return last_seen_uid
+    newest_uid = max(new_uids)
+
+    # Let the server drop mail that is not for us; the substring matches of
+    # SEARCH are re-checked exactly against the headers below.
+    criteria = ["UID", f"{last_seen_uid + 1}:{newest_uid}", "TO", TARGET_ADDRESS]
+    if ALLOWED_SENDER_DOMAIN:
+        criteria += ["FROM", f"@{ALLOWED_SENDER_DOMAIN}"]
+    # Skip mail whose job is still running from a pass that was interrupted.
+    uids = [uid for uid in server.search(criteria) if uid > last_seen_uid and uid not in jobs]
+    uids.sort()  # servers usually answer in UID order already; sort in place just in case
 
     total = len(uids)
-    print(f"📥 Found {total} new message(s)")
+    print(f"📥 Found {len(new_uids)} new message(s), {total} addressed to {TARGET_ADDRESS}")
+
+    # Network (fetching) and CPU (parsing, handlers) overlap: a producer
+    # thread stays at most two batches ahead of this loop.
+    fetched: queue.Queue = queue.Queue(maxsize=2)
+    stop = threading.Event()
+    producer = threading.Thread(
+        target=prefetch_batches,
+        args=(server, uids, fetched, stop),
+        daemon=True,
+    )
+    producer.start()
+
+    done_uids = []
+    completed = False
+    try:
+        while True:
+            error, item = fetched.get()
+            if error is not None:
+                raise error
+            if item is None:
+                # The producer also ends early on shutdown, leaving batches unseen.
+                completed = not shutdown_requested
+                break
+            upto_uid, keep_uids, messages = item
+
+            stopped_at = None
+            for uid in keep_uids:
+                if shutdown_requested:
+                    print("🛑 Shutdown detected mid-batch")
+                    stopped_at = uid
+                    break
+
+                try:
+                    raw = messages[uid][b"RFC822"]
+                    full_msg = _load_pyzmail()(raw)
+                except Exception as e:
+                    print(f"⚠️ Failed to parse message UID {uid}: {e}")
+                    continue
 
-    for batch_num, uid_batch in enumerate(chunked(sorted(uids), FETCH_BATCH_SIZE), start=1):
-        if shutdown_requested:
-            print("🛑 Shutdown detected before batch fetch")
-            break
-        print(f"📦 Fetching batch {batch_num} ({len(uid_batch)} messages)")
+                from_emails = [email for _, email in full_msg.get_addresses("from")]
+                print(f"\n📨 MATCHING EMAIL UID {uid}")
+                print("From:", from_emails)
+                print("Subject:", full_msg.get_subject())
 
-        # Fetch full message for body
-        messages = server.fetch(uid_batch, ["RFC822"])
+                # Save the raw email and hand it to the worker pool
+                try:
+                    eml_path, meta = save_email(raw, full_msg, uid)
 
-        for uid in uid_batch:
-            if shutdown_requested:
-                print("🛑 Shutdown detected mid-batch")
-                return last_seen_uid
+                    if snippet := meta["text_snippet"]:
+                        print(f"Body snippet: {snippet[:100]}".replace('\n', ' '))
+                    elif snippet := meta["html_snippet"]:
+                        print(f"Body snippet: <HTML> {snippet[:100]}".replace('\n', ' '))
+                    else:
+                        print("Body snippet: <empty>")
 
-            try:
-                full_msg = pyzmail.PyzMessage.factory(messages[uid][b"RFC822"])
-            except Exception as e:
-                print(f"⚠️ Failed to parse message UID {uid}: {e}")
-                last_seen_uid = max(last_seen_uid, uid)
-                save_state(last_seen_uid)
-                continue
+                    print(f"💾 Email saved: {eml_path}")
+                    jobs.add(uid, eml_path)
 
-            to_emails = [email.lower() for _, email in full_msg.get_addresses("to")]
+                except Exception as e:
+                    print(f"⚠️ Failed to save/invoke handler: {e}")
+                    traceback.print_exc()
 
-            # Check target address
-            if TARGET_ADDRESS.lower() not in to_emails:
-                last_seen_uid = max(last_seen_uid, uid)
-                save_state(last_seen_uid)
-                continue
+            last_seen_uid = max(last_seen_uid, stopped_at - 1 if stopped_at else upto_uid)
+            # One durable write per batch; a crash only replays part of one batch.
+            done_uids += jobs.reap()
+            jobs.commit_state(last_seen_uid)
 
-            # Check allowed sender domain
-            from_emails = [email for _, email in full_msg.get_addresses("from")]
-            if ALLOWED_SENDER_DOMAIN:
-                if not any(email.lower().endswith(f"@{ALLOWED_SENDER_DOMAIN.lower()}") for email in from_emails):
-                    print(f"❌ Ignored email from disallowed domain: {from_emails}")
-                    last_seen_uid = max(last_seen_uid, uid)
-                    save_state(last_seen_uid)
-                    continue
+            if shutdown_requested:
+                break
+    finally:
+        # Unblock and wait for the producer before touching the connection again.
+        stop.set()
+        while producer.is_alive():
+            try:
+                fetched.get(timeout=1)
+            except queue.Empty:
+                pass
+        producer.join()
+        delete_processed(server, done_uids)
 
-            print(f"\n📨 MATCHING EMAIL UID {uid}")
-            print("From:", from_emails)
-            print("Subject:", full_msg.get_subject())
+    # Everything up to the newest UID has been submitted or filtered out.
+    if completed:
+        last_seen_uid = max(last_seen_uid, newest_uid)
 
-            # Save JSON and call handler
-            try:
-                json_path, body_text, body_html = save_email_json(full_msg, uid)
-
-                # Print snippet from the already-decoded body
-                if body_text:
-                    snippet = body_text[:100].replace('\n', ' ')
-                    print(f"Body snippet: {snippet}")
-                elif body_html:
-                    snippet = body_html[:100].replace('\n', ' ')
-                    print(f"Body snippet: <HTML> {snippet}")
-                else:
-                    print("Body snippet: <empty>")
-
-                print(f"💾 Email saved as JSON: {json_path}")
-
-                # Use subprocess.run with timeout for better control
-                result = subprocess.run(
-                    [sys.executable, "handle_email.py", json_path],
-                    timeout=120,  # 2 minute timeout for PDF generation
-                    capture_output=True,
-                    text=True
-                )
-
-                if result.returncode == 0:
-                    print(f"⚡ Successfully processed UID {uid}")
-                    if result.stdout:
-                        print(f"Handler output: {result.stdout}")
-                    # Delete the original email from the inbox now that the PDF was sent
-                    try:
-                        server.delete_messages([uid])
-                        server.expunge()
-                        print(f"🗑 Deleted UID {uid} from inbox")
-                    except Exception as del_err:
-                        print(f"⚠️ Could not delete UID {uid} from inbox: {del_err}")
-                else:
-                    print(f"⚠️ Handler failed with code {result.returncode}")
-                    if result.stderr:
-                        print(f"Handler error: {result.stderr}")
-                    # Don't delete JSON on failure for debugging
-
-            except subprocess.TimeoutExpired:
-                print(f"⚠️ Handler timed out for UID {uid}")
-            except Exception as e:
-                print(f"⚠️ Failed to save/invoke handler: {e}")
-                import traceback
-                traceback.print_exc()
-
-            last_seen_uid = max(last_seen_uid, uid)
-            save_state(last_seen_uid)
-
-    print(f"💾 last_seen_uid saved = {last_seen_uid}")
+    print(f"💾 last_seen_uid saved = {jobs.commit_state(last_seen_uid)}")
     return last_seen_uid
 
 # ---- main loop ----
+def setup() -> None:
+    """Check the config and prepare everything the daemon needs before any thread starts."""
+    global JSON_DIR_FD
+    required_vars = [IMAP_SERVER, EMAIL_ACCOUNT, EMAIL_PASSWORD, TARGET_ADDRESS]
+    if not all(required_vars):
+        raise RuntimeError("Missing required environment variables")
+
+    os.makedirs(JSON_DIR, exist_ok=True)
+    JSON_DIR_FD = os.open(JSON_DIR, os.O_RDONLY | os.O_DIRECTORY)
+
+    signal.signal(signal.SIGINT, request_shutdown)
+    signal.signal(signal.SIGTERM, request_shutdown)
+
+    start_handler_pool()
+
 def watch_inbox():
     last_seen_uid = load_state()
     print(f"🔁 Starting from last_seen_uid = {last_seen_uid}")
+    connection = ConnectionHolder()
+    jobs = PendingJobs()
 
     # Initial run skip only if last_seen_uid is 0
     if last_seen_uid == 0:
         try:
-            with connect() as server:
-                print("⏩ Initial run detected. Skipping old emails…")
+            server = connection.get()
+            print("⏩ Initial run detected. Skipping old emails…")
+            # SELECT already told us the next UID; only search if it didn't.
+            uid_next = connection.select_info.get(b"UIDNEXT")
+            if uid_next:
+                last_seen_uid = max(0, int(uid_next) - 1)
+                skipped = connection.select_info.get(b"EXISTS", 0)
+            else:
                 all_uids = server.search(["ALL"])
-                if all_uids:
-                    last_seen_uid = max(all_uids)
-                    save_state(last_seen_uid)
-                    print(f"⏩ Skipped {len(all_uids)} old message(s). Starting from UID {last_seen_uid}")
+                last_seen_uid = max(all_uids, default=0)
+                skipped = len(all_uids)
+            if last_seen_uid:
+                save_state(last_seen_uid)
+                print(f"⏩ Skipped {skipped} old message(s). Starting from UID {last_seen_uid}")
         except Exception as e:
             print("⚠️ Could not connect for initial UID fetch:", e)
             time.sleep(5)
 
     while not shutdown_requested:
         try:
-            with connect() as server:
-                last_seen_uid = process_new_messages(server, last_seen_uid)
-
-                while not shutdown_requested:
-                    print(f"😴 Entering IDLE (timeout={IDLE_TIMEOUT}s)")
-                    server.idle()
-                    responses = server.idle_check(timeout=IDLE_TIMEOUT)
-                    server.idle_done()
-
-                    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                    if responses:
-                        print(f"\n🔔 {now} | Server updates: {responses}")
-                        last_seen_uid = process_new_messages(server, last_seen_uid)
-                    else:
-                        print(f"\n⏰ {now} | IDLE timeout, refreshing")
+            server = connection.get()
+            last_seen_uid = process_new_messages(server, last_seen_uid, jobs)
+
+            while not shutdown_requested:
+                # While PDFs are being generated, wake up regularly to reap them.
+                timeout = HANDLER_POLL_INTERVAL if jobs else IDLE_TIMEOUT
+                if timeout == IDLE_TIMEOUT:
+                    print(f"😴 Entering IDLE (timeout={timeout}s)")
+                server.idle()
+                responses = server.idle_check(timeout=timeout)
+                server.idle_done()
+
+                expunged = False
+                if jobs:
+                    expunged = delete_processed(server, jobs.reap())
+                    jobs.commit_state(last_seen_uid)
+
+                now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+                idle_timed_out = not responses and timeout == IDLE_TIMEOUT
+                if responses:
+                    print(f"\n🔔 {now} | Server updates: {responses}")
+                elif idle_timed_out:
+                    print(f"\n⏰ {now} | IDLE timeout, checking for missed mail")
+                # EXISTS for mail that arrived outside IDLE (e.g. during the
+                # expunge above) never reaches us, so also search after an
+                # expunge and on a full IDLE timeout; the short reap polls don't.
+                if has_new_mail(responses) or expunged or idle_timed_out:
+                    last_seen_uid = process_new_messages(server, last_seen_uid, jobs)
 
         except Exception as e:
             if shutdown_requested:
                 break
-            print("\n⚠️ Connection error. Reconnecting…")
+            print("\n⚠️ Connection error. Retrying…")
             print("Reason:", e)
-            import traceback
             traceback.print_exc()
             time.sleep(10)
 
+    # Let in-flight handler jobs finish before exiting.
+    if jobs:
+        print(f"⏳ Waiting for {len(jobs)} handler job(s)…")
+        finished = jobs.drain()
+        try:
+            delete_processed(connection.get(), finished)
+        except Exception as e:
+            print(f"⚠️ Could not delete processed emails: {e}")
+    EXECUTOR.shutdown(wait=True, cancel_futures=False)
+    connection.close()
     print("✅ Clean shutdown complete")
     save_state(last_seen_uid)
     sys.exit(0)
 
 if __name__ == "__main__":
+    setup()
     watch_inbox()
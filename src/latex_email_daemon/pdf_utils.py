@@ -6,20 +6,24 @@ front-end can reuse LaTeX escaping, HTML→LaTeX conversion, paragraph
 splitting, and pdflatex invocation without duplicating code.
 """
 
+import functools
+import hashlib
 import os
 import re
+import stat
 import subprocess
 import tempfile
+import threading
+import time
+from collections import OrderedDict
+from html.parser import HTMLParser
 from typing import Tuple
 
-from bs4 import BeautifulSoup, NavigableString
-
 # ---------------------------------------------------------------------------
 # LaTeX character escaping
 # ---------------------------------------------------------------------------
 
-_LATEX_ESCAPE_PATTERN = re.compile(r'[\\%$#_{}~^&]')
-_LATEX_REPLACEMENTS = {
+_LATEX_MAP = {
     '\\': r'\textbackslash{}',
     '%': r'\%',
     '$': r'\$',
@@ -31,30 +35,47 @@ _LATEX_REPLACEMENTS = {
     '^': r'\^{}',
     '&': r'\&',
 }
+_LATEX_TRANS = str.maketrans(_LATEX_MAP)
+# Same escaping, plus every newline becomes a forced line break (line
+# endings are normalised to '\n' before this is applied).
+_LATEX_LINES_TRANS = str.maketrans({**_LATEX_MAP, '\n': r'\\'})
+
+
+_ESCAPE_CACHE_MAX_LEN = 256
+
+
+@functools.lru_cache(maxsize=2048)
+def _latex_escape_cached(text: str) -> str:
+    return text.translate(_LATEX_TRANS)
 
 
 def latex_escape(text: str) -> str:
     """Escape special LaTeX characters in plain text."""
     if not text:
         return ""
-    return _LATEX_ESCAPE_PATTERN.sub(lambda m: _LATEX_REPLACEMENTS[m.group()], text)
+    # Short strings (link targets, signature lines, boilerplate) repeat a lot
+    # across HTML mail; long bodies are unique and would only churn the cache.
+    if len(text) < _ESCAPE_CACHE_MAX_LEN:
+        return _latex_escape_cached(text)
+    return text.translate(_LATEX_TRANS)
 
 
 # ---------------------------------------------------------------------------
 # Filename sanitisation
 # ---------------------------------------------------------------------------
 
+_UMLAUT_TRANS = str.maketrans({
+    'ä': 'ae', 'ö': 'oe', 'ü': 'ue',
+    'Ä': 'Ae', 'Ö': 'Oe', 'Ü': 'Ue',
+    'ß': 'ss',
+})
+_UNSAFE_FILENAME_PATTERN = re.compile(r'[^a-zA-Z0-9_-]+')
+
+
 def sanitize_filename(text: str, max_length: int = 50) -> str:
     """Convert arbitrary text to a safe ASCII-only filename."""
-    replacements = {
-        'ä': 'ae', 'ö': 'oe', 'ü': 'ue',
-        'Ä': 'Ae', 'Ö': 'Oe', 'Ü': 'Ue',
-        'ß': 'ss',
-    }
-    for umlaut, replacement in replacements.items():
-        text = text.replace(umlaut, replacement)
-    text = text.encode('ascii', 'ignore').decode('ascii')
-    text = re.sub(r'[^a-zA-Z0-9_-]+', '_', text)
+    text = text.translate(_UMLAUT_TRANS).encode('ascii', 'ignore').decode('ascii')
+    text = _UNSAFE_FILENAME_PATTERN.sub('_', text)
     text = text.strip('_')[:max_length]
     return text if text else "document"
 
@@ -63,53 +84,138 @@ def sanitize_filename(text: str, max_length: int = 50) -> str:
 # HTML → LaTeX conversion
 # ---------------------------------------------------------------------------
 
-def html_to_latex(html_content: str) -> str:
-    """Convert HTML content to LaTeX, preserving bold/italic/links/lists."""
-    soup = BeautifulSoup(html_content, 'html.parser')
-
-    def process_element(element, parent_tag=None):
-        if isinstance(element, NavigableString):
-            text = str(element)
-            return latex_escape(text) if text else ""
-
-        tag = element.name
-        children_latex = ''.join(process_element(child, tag) for child in element.children)
-
-        if tag in ['strong', 'b']:
-            return f'\\textbf{{{children_latex}}}'
-        elif tag in ['em', 'i']:
-            return f'\\textit{{{children_latex}}}'
-        elif tag == 'u':
-            return f'\\uline{{{children_latex}}}'
+# Inline tags that simply wrap their content.
+_TAG_WRAP = {
+    'strong': ('\\textbf{', '}'),
+    'b': ('\\textbf{', '}'),
+    'em': ('\\textit{', '}'),
+    'i': ('\\textit{', '}'),
+    'u': ('\\uline{', '}'),
+}
+_LIST_ENVIRONMENTS = {'ul': 'itemize', 'ol': 'enumerate'}
+# Elements that never have content (and usually no end tag).
+_VOID_ELEMENTS = {
+    'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input',
+    'link', 'meta', 'param', 'source', 'track', 'wbr',
+}
+_PRESERVE_WHITESPACE = {'pre', 'textarea'}
+_ASCII_SPACES = ' \n\t\f\r'
+
+
+class _LatexEmitter(HTMLParser):
+    """
+    Streaming HTML → LaTeX converter.
+
+    No document tree is built: each open element owns one output list on
+    a stack, and when its end tag arrives the parts are wrapped and moved
+    into the parent's list, so memory is bounded by nesting depth.  Like
+    the html.parser tree builder, missing end tags are closed at the end
+    of input, stray end tags are ignored and whitespace-only text collapses
+    to a single space or newline.
+    """
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        # (tag, href, parts) per open element; the root collects the result.
+        self._stack: list[tuple[str, str, list[str]]] = [('', '', [])]
+        # Text since the last markup event, emitted as one string.
+        self._pending: list[str] = []
+
+    def _in_list(self) -> bool:
+        # Only <li> children of <ul>/<ol> produce output.
+        return self._stack[-1][0] in _LIST_ENVIRONMENTS
+
+    def _flush_text(self):
+        if not self._pending:
+            return
+        text = ''.join(self._pending)
+        self._pending.clear()
+        if self._in_list():
+            return
+        if not text.strip(_ASCII_SPACES) and not any(
+            t in _PRESERVE_WHITESPACE for t, _, _ in self._stack
+        ):
+            text = '\n' if '\n' in text else ' '
+        self._stack[-1][2].append(latex_escape(text))
+
+    def handle_starttag(self, tag, attrs):
+        self._flush_text()
+        if tag == 'br':
+            if not self._in_list():
+                self._stack[-1][2].append('\\\\')
+            return
+        if tag in _VOID_ELEMENTS:
+            return
+        href = (dict(attrs).get('href') or '') if tag == 'a' else ''
+        self._stack.append((tag, href, []))
+
+    def handle_endtag(self, tag):
+        self._flush_text()
+        for depth in range(len(self._stack) - 1, 0, -1):
+            if self._stack[depth][0] == tag:
+                while len(self._stack) > depth:
+                    self._close_element()
+                return
+
+    def handle_data(self, data):
+        self._pending.append(data)
+
+    # Comments, doctypes and processing instructions produce no output but,
+    # like tags, end the current run of text.
+    def handle_comment(self, data):
+        self._flush_text()
+
+    handle_decl = handle_pi = unknown_decl = handle_comment
+
+    def _close_element(self):
+        tag, href, parts = self._stack.pop()
+        parent = self._stack[-1][2]
+
+        if self._in_list():
+            if tag == 'li':
+                # One entry per item so the list can emit \item for each.
+                parent.append(''.join(parts))
+        elif tag in _TAG_WRAP:
+            prefix, suffix = _TAG_WRAP[tag]
+            parent.append(prefix)
+            parent.extend(parts)
+            parent.append(suffix)
         elif tag == 'a':
-            href = element.get('href', '')
-            return f'\\href{{{latex_escape(href)}}}{{{children_latex}}}'
-        elif tag == 'br':
-            return '\\\\'
-        elif tag == 'ul':
-            items = []
-            for li in element.find_all('li', recursive=False):
-                item_content = ''.join(process_element(child, 'ul') for child in li.children)
-                items.append(f'\\item {item_content}')
-            return '\\begin{itemize}\n' + '\n'.join(items) + '\n\\end{itemize}'
-        elif tag == 'ol':
-            items = []
-            for li in element.find_all('li', recursive=False):
-                item_content = ''.join(process_element(child, 'ol') for child in li.children)
-                items.append(f'\\item {item_content}')
-            return '\\begin{enumerate}\n' + '\n'.join(items) + '\n\\end{enumerate}'
+            parent.append(f'\\href{{{latex_escape(href)}}}{{')
+            parent.extend(parts)
+            parent.append('}')
+        elif tag in _LIST_ENVIRONMENTS:
+            env = _LIST_ENVIRONMENTS[tag]
+            items = '\n'.join(f'\\item {item}' for item in parts)
+            parent.append(f'\\begin{{{env}}}\n{items}\n\\end{{{env}}}')
         elif tag == 'p':
-            return children_latex + '\n\n' if children_latex.strip() else ''
+            content = ''.join(parts)
+            if content.strip():
+                parent.append(content)
+                parent.append('\n\n')
         elif tag == 'div':
-            if children_latex.strip() in ['', '\\\\']:
-                return '\n\n'
-            return children_latex + '\n\n' if children_latex.strip() else ''
-        elif tag == 'li':
-            return children_latex
+            content = ''.join(parts)
+            if content.strip() in ['', '\\\\']:
+                parent.append('\n\n')
+            else:
+                parent.append(content)
+                parent.append('\n\n')
         else:
-            return children_latex
+            parent.extend(parts)
+
+    def result(self) -> str:
+        self.close()
+        self._flush_text()
+        while len(self._stack) > 1:
+            self._close_element()
+        return ''.join(self._stack[0][2])
+
 
-    result = process_element(soup)
+def html_to_latex(html_content: str) -> str:
+    """Convert HTML content to LaTeX, preserving bold/italic/links/lists."""
+    emitter = _LatexEmitter()
+    emitter.feed(html_content)
+    result = emitter.result()
     result = re.sub(r'\\\\(\\\\)+', r'\n\n', result)
     result = re.sub(r'\n{3,}', '\n\n', result)
     return result.strip()
@@ -119,24 +225,21 @@ def html_to_latex(html_content: str) -> str:
 # Paragraph splitting
 # ---------------------------------------------------------------------------
 
+# Every line boundary str.splitlines() knows, so they all become '\n'.
+_LINE_BREAK = re.compile(r'\r\n?|[\v\f\x1c-\x1e\x85\u2028\u2029]')
+# A line break followed by one or more blank (whitespace-only) lines.
+_PARAGRAPH_SPLIT = re.compile(r'\n(?:[^\S\n]*\n)+')
+
+
 def split_paragraphs(text: str) -> Tuple[str, str, str, str]:
     """Split plain text into (first, second, third, rest) with LaTeX escaping."""
     if not text or not text.strip():
         return "", "", "", ""
 
-    lines = text.splitlines()
-    paragraphs = []
-    current = []
-
-    for line in lines:
-        if line.strip() == "":
-            if current:
-                paragraphs.append("\n".join(current))
-                current = []
-        else:
-            current.append(line)
-    if current:
-        paragraphs.append("\n".join(current))
+    # Pad with newlines so blank lines at either end split like inner ones;
+    # leading spaces of the first line are kept, as before.
+    text = "\n" + _LINE_BREAK.sub("\n", text) + "\n"
+    paragraphs = [p.strip("\n") for p in _PARAGRAPH_SPLIT.split(text) if p.strip()]
 
     if not paragraphs:
         return "", "", "", ""
@@ -146,9 +249,9 @@ def split_paragraphs(text: str) -> Tuple[str, str, str, str]:
     third  = paragraphs[2] if len(paragraphs) > 2 else ""
     rest   = "\n\n".join(paragraphs[3:]) if len(paragraphs) > 3 else ""
 
-    first  = latex_escape(first).replace("\n", r"\\")  if first  else ""
-    second = latex_escape(second).replace("\n", r"\\") if second else ""
-    third  = latex_escape(third).replace("\n", r"\\")  if third  else ""
+    first  = first.translate(_LATEX_LINES_TRANS)
+    second = second.translate(_LATEX_LINES_TRANS)
+    third  = third.translate(_LATEX_LINES_TRANS)
     rest   = latex_escape(rest)
 
     return first, second, third, rest
@@ -244,6 +347,200 @@ REQUIRED_PLACEHOLDERS = [
     "{{THIRD_PARAGRAPH}}",
     "{{BODY}}",
 ]
+_PLACEHOLDER_PATTERN = re.compile(r'\{\{(\w+)\}\}')
+_PLACEHOLDER_NAMES = {p[2:-2] for p in REQUIRED_PLACEHOLDERS}
+
+
+def missing_placeholders(latex_template: str) -> list[str]:
+    """Return the REQUIRED_PLACEHOLDERS absent from *latex_template* (one scan)."""
+    present = set(_PLACEHOLDER_PATTERN.findall(latex_template))
+    return [p for p in REQUIRED_PLACEHOLDERS if p[2:-2] not in present]
+
+
+@functools.lru_cache(maxsize=32)
+def _read_template(template_file: str, mtime_ns: int) -> str:
+    with open(template_file, "r", encoding="utf-8") as f:
+        latex_template = f.read()
+
+    missing = missing_placeholders(latex_template)
+    if missing:
+        raise RuntimeError(f"Template missing placeholders: {missing}")
+    return latex_template
+
+
+def load_template(template_file: str) -> str:
+    """
+    Return the validated contents of *template_file*.
+
+    Cached per (path, mtime): a long-running process reads and checks each
+    template once, yet still picks up edits made through the web front-end.
+    Raises RuntimeError if the file is missing or lacks placeholders.
+    """
+    try:
+        mtime_ns = os.stat(template_file).st_mtime_ns
+        return _read_template(template_file, mtime_ns)
+    except FileNotFoundError:
+        raise RuntimeError(f"LaTeX template not found: {template_file}")
+
+
+def fill_template(
+    latex_template: str,
+    subject: str,
+    first_paragraph: str,
+    second_paragraph: str,
+    third_paragraph: str,
+    body: str,
+) -> str:
+    """Substitute the placeholders of an already loaded template."""
+    # Single pass over the template; unknown {{NAME}}s are left as they are.
+    values = {
+        "SUBJECT": latex_escape(subject),
+        "FIRST_PARAGRAPH": first_paragraph,
+        "SECOND_PARAGRAPH": second_paragraph,
+        "THIRD_PARAGRAPH": third_paragraph,
+        "BODY": body,
+    }
+    return _PLACEHOLDER_PATTERN.sub(
+        lambda m: values.get(m.group(1), m.group(0)), latex_template
+    )
+
+# pdflatex's scratch files live in RAM (tmpfs) when the system offers it.
+_SCRATCH_DIR = "/dev/shm" if os.access("/dev/shm", os.W_OK) else None
+
+# Dumped preamble formats, keyed by a hash of the preamble text. The
+# directory is per user and must be private: pdflatex loads whatever .fmt
+# it finds there.
+_FORMAT_DIR = os.path.join(tempfile.gettempdir(), f"latex-email-daemon-fmt-{os.getuid()}")
+_FORMAT_FAILED: set[str] = set()
+_FORMAT_BUILT: set[str] = set()  # formats this process built itself
+# Preambles pulling in other files can change without their text changing.
+_EXTERNAL_INPUT = re.compile(r'\\(?:input|include|InputIfFileExists)\b')
+
+
+@functools.cache
+def _format_dir_ok() -> bool:
+    """Create _FORMAT_DIR (mode 0700) and check that it is ours and private."""
+    try:
+        os.makedirs(_FORMAT_DIR, mode=0o700, exist_ok=True)
+        st = os.lstat(_FORMAT_DIR)
+    except OSError:
+        return False
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or st.st_mode & 0o077:
+        print(f"⚠️ Not using preamble formats: {_FORMAT_DIR} is not a private directory")
+        return False
+    return True
+
+
+def _preamble_format(latex_template: str) -> str | None:
+    """
+    Return the name of a precompiled format holding the template's preamble,
+    building it with mylatexformat on first use.
+
+    Package loading dominates pdflatex runtime for short letters; with the
+    preamble dumped into a .fmt, every later run starts at \\begin{document}.
+    Returns None (compile normally) if the preamble contains placeholders or
+    \\input's other files, or the format cannot be built.
+    """
+    begin = latex_template.find("\\begin{document}")
+    if begin < 0:
+        return None
+    preamble = latex_template[:begin]
+    if not _PLACEHOLDER_NAMES.isdisjoint(_PLACEHOLDER_PATTERN.findall(preamble)):
+        return None
+    if _EXTERNAL_INPUT.search(preamble) or not _format_dir_ok():
+        return None
+
+    name = "preamble-" + hashlib.sha256(preamble.encode("utf-8")).hexdigest()[:16]
+    if name in _FORMAT_FAILED:
+        return None
+    if os.path.exists(os.path.join(_FORMAT_DIR, name + ".fmt")):
+        return name
+
+    with tempfile.TemporaryDirectory(dir=_FORMAT_DIR) as tmpdir:
+        src_path = os.path.join(tmpdir, name + ".tex")
+        fmt_path = os.path.join(tmpdir, name + ".fmt")
+        with open(src_path, "w", encoding="utf-8") as f:
+            f.write(preamble + "\\begin{document}\n\\end{document}\n")
+        try:
+            subprocess.run(
+                ["pdflatex", "-ini", f"-jobname={name}", "-interaction=nonstopmode",
+                 "-output-directory", tmpdir, "&pdflatex", "mylatexformat.ltx", src_path],
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+                timeout=60,
+                check=False,
+            )
+        except (FileNotFoundError, subprocess.TimeoutExpired):
+            pass
+        if not os.path.exists(fmt_path):
+            _FORMAT_FAILED.add(name)
+            return None
+        os.replace(fmt_path, os.path.join(_FORMAT_DIR, name + ".fmt"))
+    _FORMAT_BUILT.add(name)
+    return name
+
+
+def _drop_format(name: str) -> None:
+    """
+    Delete a format pdflatex could not use (e.g. dumped by an older TeX
+    Live), so the next compile rebuilds it.  One this process built itself
+    is not tried again.
+    """
+    try:
+        os.remove(os.path.join(_FORMAT_DIR, name + ".fmt"))
+    except FileNotFoundError:
+        pass
+    if name in _FORMAT_BUILT:
+        _FORMAT_FAILED.add(name)
+
+
+# Recently compiled PDFs, keyed by a hash of the filled-in LaTeX source.
+# Entries only live for a minute: enough for a web preview followed by its
+# download, short enough that \today or an edited \input file is not served
+# stale from an otherwise identical source.
+_PDF_CACHE: OrderedDict[str, tuple[float, bytes]] = OrderedDict()
+_PDF_CACHE_SIZE = 16
+_PDF_CACHE_TTL = 60  # seconds
+_pdf_cache_lock = threading.Lock()
+
+# Templates using these need a second run to resolve references.
+_RERUN_PATTERN = re.compile(r'\\(?:ref|pageref|eqref|autoref|cref|cite\w*|tableofcontents)\b')
+
+
+def _run_pdflatex(
+    tex_path: str, output_dir: str, fmt: str | None, draft: bool = False
+) -> subprocess.CompletedProcess:
+    cmd = ["pdflatex", "-no-shell-escape"]
+    env = None
+    if fmt:
+        cmd.append(f"-fmt={fmt}")
+        # Trailing separator keeps kpathsea's default format path as well.
+        env = {**os.environ, "TEXFORMATS": _FORMAT_DIR + os.pathsep}
+    if draft:
+        # Only the .aux matters on a first pass; skip writing the PDF.
+        cmd.append("-draftmode")
+    cmd += ["-interaction=nonstopmode", "-output-directory", output_dir, tex_path]
+    try:
+        return subprocess.run(
+            cmd,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            timeout=30,
+            check=False,
+            env=env,
+        )
+    except FileNotFoundError:
+        raise RuntimeError("pdflatex not found — is LaTeX installed?")
+    except subprocess.TimeoutExpired:
+        raise RuntimeError("pdflatex timed out after 30 seconds")
+
+
+def _typeset(
+    tex_path: str, output_dir: str, fmt: str | None, two_pass: bool
+) -> subprocess.CompletedProcess:
+    if two_pass:
+        _run_pdflatex(tex_path, output_dir, fmt, draft=True)
+    return _run_pdflatex(tex_path, output_dir, fmt)
 
 
 def compile_pdf(
@@ -261,48 +558,48 @@ def compile_pdf(
     pdflatex, and return the raw PDF bytes.
 
     Raises RuntimeError on template/compilation errors.
-    All intermediate files are cleaned up automatically.
+    All intermediate files are cleaned up automatically.  An identical
+    document compiled within the last minute (e.g. a web preview followed
+    by its download) is served from memory without running pdflatex again.
     """
-    # ---- load template ----
-    try:
-        with open(template_file, "r", encoding="utf-8") as f:
-            latex_template = f.read()
-    except FileNotFoundError:
-        raise RuntimeError(f"LaTeX template not found: {template_file}")
+    latex_template = load_template(template_file)
+    latex_content = fill_template(
+        latex_template, subject, first_paragraph, second_paragraph, third_paragraph, body
+    )
 
-    missing = [p for p in REQUIRED_PLACEHOLDERS if p not in latex_template]
-    if missing:
-        raise RuntimeError(f"Template missing placeholders: {missing}")
+    cache_key = hashlib.sha256(latex_content.encode("utf-8")).hexdigest()
+    with _pdf_cache_lock:
+        cached = _PDF_CACHE.pop(cache_key, None)
+        if cached and time.monotonic() - cached[0] < _PDF_CACHE_TTL:
+            _PDF_CACHE[cache_key] = cached
+            return cached[1]
+
+    pdf_bytes = _compile_latex(latex_template, latex_content)
+    with _pdf_cache_lock:
+        _PDF_CACHE[cache_key] = (time.monotonic(), pdf_bytes)
+        if len(_PDF_CACHE) > _PDF_CACHE_SIZE:
+            _PDF_CACHE.popitem(last=False)
+    return pdf_bytes
 
-    latex_content = (
-        latex_template
-        .replace("{{SUBJECT}}", latex_escape(subject))
-        .replace("{{FIRST_PARAGRAPH}}", first_paragraph)
-        .replace("{{SECOND_PARAGRAPH}}", second_paragraph)
-        .replace("{{THIRD_PARAGRAPH}}", third_paragraph)
-        .replace("{{BODY}}", body)
-    )
 
-    # ---- compile in a temp directory ----
-    with tempfile.TemporaryDirectory() as tmpdir:
+def _compile_latex(latex_template: str, latex_content: str) -> bytes:
+    """Run pdflatex on *latex_content* in a scratch directory."""
+    with tempfile.TemporaryDirectory(dir=_SCRATCH_DIR) as tmpdir:
         tex_path = os.path.join(tmpdir, "document.tex")
         pdf_path = os.path.join(tmpdir, "document.pdf")
 
         with open(tex_path, "w", encoding="utf-8") as f:
             f.write(latex_content)
 
-        try:
-            result = subprocess.run(
-                ["pdflatex", "-interaction=nonstopmode", "-output-directory", tmpdir, tex_path],
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                timeout=30,
-                check=False,
-            )
-        except FileNotFoundError:
-            raise RuntimeError("pdflatex not found — is LaTeX installed?")
-        except subprocess.TimeoutExpired:
-            raise RuntimeError("pdflatex timed out after 30 seconds")
+        fmt = _preamble_format(latex_template)
+        two_pass = _RERUN_PATTERN.search(latex_template) is not None
+        result = _typeset(tex_path, tmpdir, fmt, two_pass)
+        if fmt and not os.path.exists(pdf_path):
+            # Stale or incompatible format — retry with the full preamble.
+            result = _typeset(tex_path, tmpdir, None, two_pass)
+            if os.path.exists(pdf_path):
+                # The document is fine, so the format was at fault.
+                _drop_format(fmt)
 
         if not os.path.exists(pdf_path):
             stdout = result.stdout.decode("utf-8", errors="replace")
@@ -0,0 +1,112 @@
+"""
+smtp_pool.py — Reusable authenticated SMTP connections.
+
+Keeps a small pool of logged-in smtplib.SMTP sessions so that consecutive
+emails skip the TCP + STARTTLS + AUTH handshake.  Each connection is probed
+with NOOP before it is handed out and recycled after a fixed number of sends.
+"""
+
+import queue
+import smtplib
+from contextlib import contextmanager
+
+
+class SMTPConnection:
+    """One authenticated SMTP session and the number of messages sent on it."""
+
+    def __init__(self, host: str, port: int, user: str, password: str, timeout: int = 30):
+        self.host = host
+        self.port = port
+        self.user = user
+        self.password = password
+        self.timeout = timeout
+        self.smtp: smtplib.SMTP | None = None
+        self.messages_sent = 0
+
+    def connect(self) -> None:
+        """(Re)open the session: connect, STARTTLS and log in."""
+        self.close()
+        smtp = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        try:
+            smtp.starttls()
+            smtp.login(self.user, self.password)
+        except BaseException:
+            smtp.close()
+            raise
+        self.smtp = smtp
+        self.messages_sent = 0
+
+    def is_alive(self) -> bool:
+        """Health probe: True if the server still answers NOOP."""
+        if self.smtp is None:
+            return False
+        try:
+            return self.smtp.noop()[0] == 250
+        except (smtplib.SMTPException, OSError):
+            return False
+
+    def send_message(self, msg) -> None:
+        self.smtp.send_message(msg)
+        self.messages_sent += 1
+
+    def close(self) -> None:
+        if self.smtp is None:
+            return
+        try:
+            self.smtp.quit()
+        except (smtplib.SMTPException, OSError):
+            self.smtp.close()
+        self.smtp = None
+
+
+class SMTPPool:
+    """
+    Fixed-size pool of SMTPConnection objects.
+
+    Connections are opened lazily on first use, so creating a pool is free.
+    Use ``with pool.acquire() as conn: conn.send_message(msg)``.
+    """
+
+    def __init__(
+        self,
+        host: str,
+        port: int,
+        user: str,
+        password: str,
+        size: int = 5,
+        max_messages: int = 100,
+        timeout: int = 30,
+    ):
+        self.max_messages = max_messages
+        # LIFO: the most recently used session is still warm; the others can
+        # sit idle until the server drops them and only then need a new login.
+        self._idle: queue.LifoQueue[SMTPConnection] = queue.LifoQueue()
+        for _ in range(max(1, size)):
+            self._idle.put(SMTPConnection(host, port, user, password, timeout))
+
+    @contextmanager
+    def acquire(self):
+        """Borrow a healthy, logged-in connection; blocks while all are in use."""
+        conn = self._idle.get()
+        try:
+            if conn.messages_sent >= self.max_messages or not conn.is_alive():
+                conn.connect()
+            yield conn
+        except BaseException:
+            # Never hand a session in an unknown state to the next caller.
+            conn.close()
+            raise
+        finally:
+            self._idle.put(conn)
+
+    def close(self) -> None:
+        """Close every idle connection (connections currently in use are left alone)."""
+        conns = []
+        while True:
+            try:
+                conns.append(self._idle.get_nowait())
+            except queue.Empty:
+                break
+        for conn in conns:
+            conn.close()
+            self._idle.put(conn)
@@ -28,7 +28,7 @@ from pdf_utils import (
     html_to_latex,
     compile_pdf,
     sanitize_filename,
-    REQUIRED_PLACEHOLDERS,
+    missing_placeholders,
     plain_to_latex_lines,
     plain_to_latex_body,
 )
@@ -63,7 +63,7 @@ def _is_valid_template(path: str) -> bool:
     try:
         with open(path, "r", encoding="utf-8", errors="ignore") as f:
             content = f.read()
-        return all(p in content for p in REQUIRED_PLACEHOLDERS)
+        return not missing_placeholders(content)
     except OSError:
         return False
 
@@ -0,0 +1,6 @@
+import sys
+from pathlib import Path
+
+# The daemon's modules import each other by bare name (they run from their
+# own directory), so the tests do the same.
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src" / "latex_email_daemon"))
@@ -0,0 +1,144 @@
+import json
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+try:
+    import handle_email
+except ModuleNotFoundError as e:
+    if e.name != "dotenv":
+        raise
+    raise unittest.SkipTest(f"handler dependencies missing: {e}")
+
+
+class EmptyListing(list):
+    """Stand-in for an os.scandir() result that sees no files."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+class CreateUniqueFileTest(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.dir = tmp.name
+        patcher = mock.patch.object(handle_email, "PDF_DIR", self.dir)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def create(self):
+        path, f = handle_email.create_unique_file("Brief", "pdf")
+        f.close()
+        return os.path.basename(path)
+
+    def test_free_name(self):
+        self.assertEqual(self.create(), "Brief.pdf")
+
+    def test_taken_names_get_a_counter(self):
+        self.assertEqual(
+            [self.create() for _ in range(3)], ["Brief.pdf", "Brief_1.pdf", "Brief_2.pdf"]
+        )
+
+    def test_name_taken_after_listing_is_not_overwritten(self):
+        # Another worker process creates the file between our listing and open().
+        with open(os.path.join(self.dir, "Brief.pdf"), "wb") as f:
+            f.write(b"theirs")
+        with mock.patch.object(handle_email.os, "scandir", return_value=EmptyListing()):
+            self.assertEqual(self.create(), "Brief_1.pdf")
+        with open(os.path.join(self.dir, "Brief.pdf"), "rb") as f:
+            self.assertEqual(f.read(), b"theirs")
+
+
+MULTIPART_EML = b"""\
+From: Anna <anna@example.org>
+To: pdf@example.org
+Cc: bob@example.org, Anna <anna@example.org>
+Subject: =?utf-8?q?Gr=C3=BC=C3=9Fe?=
+MIME-Version: 1.0
+Content-Type: multipart/alternative; boundary="b"
+
+--b
+Content-Type: text/plain; charset=utf-8
+
+Plain body
+--b
+Content-Type: text/html; charset=utf-8
+
+<p>First</p><p>Second</p><p>Third</p><p>Rest &amp; more</p>
+--b--
+"""
+
+
+class LoadJobTest(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.dir = tmp.name
+        patcher = mock.patch("builtins.print")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def write(self, name, data: bytes) -> str:
+        path = os.path.join(self.dir, name)
+        with open(path, "wb") as f:
+            f.write(data)
+        return path
+
+    def test_read_eml(self):
+        data = handle_email.read_eml(self.write("1.eml", MULTIPART_EML))
+        self.assertEqual(data["subject"], "Grüße")
+        self.assertEqual(data["from"], [("Anna", "anna@example.org")])
+        self.assertEqual(data["cc"], [("", "bob@example.org"), ("Anna", "anna@example.org")])
+        self.assertEqual(data["bcc"], [])
+        self.assertEqual(data["text"].strip(), "Plain body")
+        self.assertIn("<p>First</p>", data["html"])
+
+    def test_unknown_charset_falls_back_to_utf8(self):
+        eml = (
+            b"From: a@example.org\nSubject: x\n"
+            b"Content-Type: text/plain; charset=no-such-charset\n\nGr\xc3\xbc\xc3\x9fe\n"
+        )
+        data = handle_email.read_eml(self.write("1.eml", eml))
+        self.assertEqual(data["text"].strip(), "Grüße")
+
+    def test_load_eml_job(self):
+        path = self.write("20240101_000000_7.eml", MULTIPART_EML)
+        job = handle_email.load_job(path)
+        self.assertEqual(job["files"], [path, path[:-len(".eml")] + ".meta.json"])
+        self.assertEqual(job["subject"], "Grüße")
+        # Sender first, duplicates dropped, order kept.
+        self.assertEqual(job["recipients"], ["anna@example.org", "bob@example.org"])
+        fields = job["fields"]
+        self.assertEqual(
+            (fields["first_paragraph"], fields["second_paragraph"], fields["third_paragraph"]),
+            ("First", "Second", "Third"),
+        )
+        self.assertEqual(fields["body"], "Rest \\& more")
+
+    def test_load_legacy_json_job(self):
+        path = self.write("7.json", json.dumps({
+            "subject": "Hi",
+            "from": [["", "anna@example.org"]],
+            "text": "One\n\nTwo",
+        }).encode())
+        job = handle_email.load_job(path)
+        self.assertEqual(job["files"], [path])
+        self.assertEqual(job["recipients"], ["anna@example.org"])
+        self.assertEqual(job["fields"]["first_paragraph"], "One")
+        self.assertEqual(job["fields"]["second_paragraph"], "Two")
+
+    def test_missing_file(self):
+        self.assertIsNone(handle_email.load_job(os.path.join(self.dir, "gone.eml")))
+
+    def test_no_recipients(self):
+        path = self.write("1.eml", b"Subject: x\n\nbody\n")
+        self.assertIsNone(handle_email.load_job(path))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,45 @@
+import queue
+import signal
+import time
+import types
+import unittest
+from unittest import mock
+
+import handler_worker
+
+
+class RunTest(unittest.TestCase):
+    def setUp(self):
+        self.started = queue.Queue()
+        previous = signal.signal(signal.SIGALRM, handler_worker._on_alarm)
+        self.addCleanup(signal.signal, signal.SIGALRM, previous)
+        patcher = mock.patch.object(handler_worker, "_started", self.started)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def run_with(self, process, timeout=5):
+        handler = types.SimpleNamespace(process=process)
+        with mock.patch.dict("sys.modules", handle_email=handler):
+            return handler_worker.run(7, "7.eml", timeout)
+
+    def test_reports_start_and_returns_exit_code(self):
+        self.assertEqual(self.run_with(lambda path: 0), 0)
+        uid, started = self.started.get_nowait()
+        self.assertEqual(uid, 7)
+        self.assertLessEqual(started, time.monotonic())
+        self.assertEqual(signal.alarm(0), 0)  # disarmed
+
+    def test_timeout_is_not_swallowed_by_handler(self):
+        def process(path):
+            try:
+                time.sleep(5)
+            except Exception:
+                return 1  # what deliver() does with a failed send
+            return 0
+
+        with self.assertRaises(handler_worker.HandlerTimeout):
+            self.run_with(process, timeout=1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,343 @@
+import base64
+import os
+import queue
+import tempfile
+import unittest
+from concurrent.futures import Future
+from concurrent.futures.process import BrokenProcessPool
+from unittest import mock
+
+try:
+    import main
+except ModuleNotFoundError as e:
+    if e.name not in ("imapclient", "dotenv"):
+        raise
+    raise unittest.SkipTest(f"daemon dependencies missing: {e}")
+
+
+class PendingJobsTest(unittest.TestCase):
+    def setUp(self):
+        self.saved = []
+        self.submitted = {}  # eml path -> futures handed out, in order
+        self.started = queue.Queue()
+        for patcher in (
+            mock.patch.object(main, "save_state", self.saved.append),
+            mock.patch.object(main, "submit_handler", self.submit),
+            mock.patch.object(main, "_STARTED", self.started),
+            mock.patch("builtins.print"),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.jobs = main.PendingJobs()
+
+    def submit(self, uid, eml_path):
+        future = Future()
+        self.submitted.setdefault(eml_path, []).append(future)
+        return future
+
+    def add(self, uid):
+        self.jobs.add(uid, f"{uid}.eml")
+        return self.submitted[f"{uid}.eml"][-1]
+
+    def test_commit_state_stops_below_oldest_unfinished_job(self):
+        self.add(7)
+        self.add(9)
+        self.assertEqual(self.jobs.commit_state(11), 6)
+        self.assertEqual(self.saved, [6])
+
+    def test_commit_state_only_writes_changes(self):
+        self.jobs.commit_state(5)
+        self.jobs.commit_state(5)
+        self.assertEqual(self.saved, [5])
+
+    def test_reap_collects_finished_jobs(self):
+        self.add(7).set_result(0)
+        self.add(8).set_result(1)
+        self.add(9)
+        self.assertEqual(self.jobs.reap(), [7])
+        self.assertEqual(len(self.jobs), 1)
+        self.assertIn(9, self.jobs)
+        self.assertEqual(self.jobs.commit_state(11), 8)
+
+        self.submitted["9.eml"][0].set_result(0)
+        self.assertEqual(self.jobs.reap(), [9])
+        self.assertEqual(self.jobs.commit_state(11), 11)
+
+    def test_timed_out_job_is_reaped_as_failed(self):
+        self.add(7).set_exception(main.handler_worker.HandlerTimeout("handler timed out"))
+        with mock.patch("builtins.print") as log:
+            self.assertEqual(self.jobs.reap(), [])
+        log.assert_any_call("⚠️ Handler timed out for UID 7")
+        self.assertNotIn(7, self.jobs)
+
+    def test_queued_job_is_not_timed_out(self):
+        self.add(7)
+        with mock.patch.object(main, "restart_handler_pool") as restart:
+            self.assertEqual(self.jobs.reap(), [])
+        restart.assert_not_called()
+        self.assertIn(7, self.jobs)
+
+    def test_stuck_job_replaces_pool(self):
+        self.add(7)
+        self.add(8)
+        started = main.time.monotonic() - main.HANDLER_TIMEOUT - main.HANDLER_KILL_GRACE - 1
+        self.started.put((7, started))
+        with mock.patch.object(main, "restart_handler_pool") as restart:
+            self.jobs.reap()
+        restart.assert_called_once()
+        self.assertNotIn(7, self.jobs)
+        self.assertIn(8, self.jobs)
+
+    def test_job_lost_with_dead_worker_is_resubmitted_once(self):
+        self.add(7).set_exception(BrokenProcessPool())
+        self.assertEqual(self.jobs.reap(), [])
+        self.assertEqual(len(self.submitted["7.eml"]), 2)
+
+        self.submitted["7.eml"][1].set_exception(BrokenProcessPool())
+        self.assertEqual(self.jobs.reap(), [])
+        self.assertEqual(len(self.submitted["7.eml"]), 2)
+        self.assertNotIn(7, self.jobs)
+
+
+class StateFileTest(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.path = os.path.join(tmp.name, "last_seen_uid.txt")
+        for patcher in (
+            mock.patch.object(main, "STATE_FILE", self.path),
+            mock.patch.object(main, "_state_map", None),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.addCleanup(self.close_map)
+
+    def close_map(self):
+        if main._state_map is not None:
+            main._state_map.close()
+
+    def reopen(self):
+        self.close_map()
+        main._state_map = None
+
+    def test_missing_file_starts_at_zero(self):
+        self.assertEqual(main.load_state(), 0)
+        self.assertEqual(os.path.getsize(self.path), main._STATE_SLOT)
+
+    def test_old_state_file_is_migrated(self):
+        with open(self.path, "w") as f:
+            f.write("12345\n")
+        self.assertEqual(main.load_state(), 12345)
+        self.assertEqual(os.path.getsize(self.path), main._STATE_SLOT)
+
+    def test_save_and_reload(self):
+        main.save_state(12345)
+        main.save_state(7)  # shorter values must not leave digits behind
+        self.reopen()
+        self.assertEqual(main.load_state(), 7)
+        with open(self.path) as f:
+            self.assertEqual(int(f.read()), 7)
+
+
+def text_part(cte: str, payload: bytes, charset: str = "utf-8"):
+    raw = (
+        b"From: a@example.org\r\nSubject: x\r\nMIME-Version: 1.0\r\n"
+        b"Content-Type: text/plain; charset=" + charset.encode() + b"\r\n"
+        b"Content-Transfer-Encoding: " + cte.encode() + b"\r\n\r\n" + payload
+    )
+    return main._load_pyzmail()(raw).text_part
+
+
+class DecodeHeadTest(unittest.TestCase):
+    TEXT = "Grüße aus Köln. " * 100
+
+    def test_base64(self):
+        encoded = base64.encodebytes(self.TEXT.encode("utf-8"))
+        head = self.TEXT.encode("utf-8")[:64].decode("utf-8", errors="replace")
+        self.assertEqual(main.decode_head(text_part("base64", encoded), n=64), head)
+
+    def test_quoted_printable(self):
+        payload = b"Gr=C3=BC=C3=9Fe aus K=C3=B6ln, mit soft=\r\nbreak."
+        self.assertEqual(
+            main.decode_head(text_part("quoted-printable", payload)),
+            "Grüße aus Köln, mit softbreak.",
+        )
+
+    def test_8bit_with_charset(self):
+        payload = "Grüße".encode("latin-1")
+        self.assertEqual(main.decode_head(text_part("8bit", payload, "iso-8859-1")), "Grüße")
+
+    def test_only_the_head_is_decoded(self):
+        payload = ("x" * 1000).encode()
+        self.assertEqual(main.decode_head(text_part("7bit", payload), n=10), "x" * 10)
+
+    def test_missing_part(self):
+        self.assertIsNone(main.decode_head(None))
+
+
+TARGET = "pdf@example.org"
+
+
+class FakeServer:
+    """The IMAPClient calls process_new_messages makes, over an in-memory inbox."""
+
+    def __init__(self, inbox):
+        self.inbox = inbox  # uid -> To address
+        self.fetches = []  # (sequence set, items) per FETCH
+
+    def search(self, criteria):
+        first, _, last = criteria[1].partition(":")
+        uids = sorted(self.inbox)
+        if last == "*":
+            return [uid for uid in uids if uid >= int(first)] or uids[-1:]
+        to = criteria[criteria.index("TO") + 1]
+        return [uid for uid in uids if int(first) <= uid <= int(last) and self.inbox[uid] == to]
+
+    def fetch(self, sequence_set, items):
+        self.fetches.append((sequence_set, items))
+        uids = []
+        for part in sequence_set.split(","):
+            first, _, last = part.partition(":")
+            uids += range(int(first), int(last or first) + 1)
+        if items == ["RFC822"]:
+            return {uid: {b"RFC822": self.message(uid)} for uid in uids}
+        return {uid: {b"BODY[HEADER.FIELDS (FROM TO)]": self.message(uid)} for uid in uids}
+
+    def message(self, uid):
+        return f"From: a@example.org\r\nTo: {self.inbox[uid]}\r\nSubject: {uid}\r\n\r\nHi".encode()
+
+    def delete_messages(self, uids):
+        pass
+
+    def expunge(self):
+        pass
+
+
+class SequenceSetTest(unittest.TestCase):
+    def test_ranges(self):
+        self.assertEqual(main.sequence_set((1, 2, 3, 5, 7, 8)), "1:3,5,7:8")
+
+    def test_single_uid(self):
+        self.assertEqual(main.sequence_set([42]), "42")
+
+
+class FetchBatchesTest(unittest.TestCase):
+    def setUp(self):
+        for patcher in (
+            mock.patch.object(main, "accept", lambda from_emails, to_emails: TARGET in to_emails),
+            mock.patch.object(main, "HEADER_FETCH_MAX", 4),
+            mock.patch.object(main, "FETCH_BATCH_SIZE", 2),
+            mock.patch.object(main, "shutdown_requested", False),
+            mock.patch("builtins.print"),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def batches(self, inbox, stop=None):
+        server = FakeServer(inbox)
+        batches = [
+            (upto_uid, list(keep_uids), sorted(messages))
+            for upto_uid, keep_uids, messages in main.fetch_batches(
+                server, sorted(inbox), stop or main.threading.Event()
+            )
+        ]
+        return batches, server.fetches
+
+    def test_upto_uid_covers_filtered_mail(self):
+        inbox = {uid: TARGET if uid in (5, 7, 8, 11) else "x@example.org" for uid in range(5, 13)}
+        batches, fetches = self.batches(inbox)
+        self.assertEqual(batches, [
+            (7, [5, 7], [5, 7]),
+            (8, [8], [8]),
+            (12, [11], [11]),
+        ])
+        self.assertEqual([seq for seq, _ in fetches], ["5:8", "5,7", "8", "9:12", "11"])
+
+    def test_header_batch_without_matches(self):
+        batches, fetches = self.batches({6: "x@example.org", 9: "x@example.org"})
+        self.assertEqual(batches, [(9, [], [])])
+        self.assertEqual(len(fetches), 1)
+
+    def test_stop_before_fetch(self):
+        stop = main.threading.Event()
+        stop.set()
+        self.assertEqual(self.batches({5: TARGET}, stop), ([], []))
+
+
+class ProcessNewMessagesTest(unittest.TestCase):
+    """How far last_seen_uid may advance after one pass over the inbox."""
+
+    # UIDs 5, 7, 8 and 11 are for us; 6, 9 and 10 are not.
+    INBOX = {5: TARGET, 6: "x@example.org", 7: TARGET, 8: TARGET,
+             9: "x@example.org", 10: "x@example.org", 11: TARGET}
+
+    def setUp(self):
+        self.saved = []
+        self.submitted = []
+        self.shutdown_after = None  # UID whose submission triggers a shutdown
+        self.unfinished = set()  # UIDs whose handler job is still running
+        for patcher in (
+            mock.patch.object(main, "TARGET_ADDRESS", TARGET),
+            mock.patch.object(main, "accept", lambda from_emails, to_emails: TARGET in to_emails),
+            mock.patch.object(main, "FETCH_BATCH_SIZE", 2),
+            mock.patch.object(main, "shutdown_requested", False),
+            mock.patch.object(main, "save_state", self.saved.append),
+            mock.patch.object(main, "save_email", self.save_email),
+            mock.patch.object(main, "submit_handler", self.submit),
+            mock.patch.object(main, "_STARTED", queue.Queue()),
+            mock.patch("builtins.print"),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.jobs = main.PendingJobs()
+
+    def save_email(self, raw, full_msg, uid):
+        return f"{uid}.eml", {"text_snippet": "Hi", "html_snippet": None}
+
+    def submit(self, uid, eml_path):
+        self.submitted.append(uid)
+        if uid == self.shutdown_after:
+            main.shutdown_requested = True
+        future = Future()
+        if uid not in self.unfinished:
+            future.set_result(0)
+        return future
+
+    def run_pass(self, last_seen_uid=4, inbox=INBOX):
+        return main.process_new_messages(FakeServer(inbox), last_seen_uid, self.jobs)
+
+    def test_complete_pass_reaches_newest_uid(self):
+        self.assertEqual(self.run_pass(), 11)
+        self.assertEqual(self.submitted, [5, 7, 8, 11])
+        self.assertEqual(self.saved[-1], 11)
+
+    def test_trailing_unwanted_mail_is_skipped(self):
+        self.assertEqual(self.run_pass(inbox={**self.INBOX, 12: "x@example.org"}), 12)
+        self.assertEqual(self.saved[-1], 12)
+
+    def test_nothing_new(self):
+        self.assertEqual(self.run_pass(last_seen_uid=11), 11)
+        self.assertEqual(self.submitted, [])
+
+    def test_state_stays_below_unfinished_job(self):
+        self.unfinished = {7}
+        self.assertEqual(self.run_pass(), 11)
+        self.assertEqual(self.saved[-1], 6)
+        self.assertIn(7, self.jobs)
+
+    def test_shutdown_mid_batch(self):
+        # 5 and 7 share the first batch; 7 is never looked at.
+        self.shutdown_after = 5
+        self.assertEqual(self.run_pass(), 6)
+        self.assertEqual(self.submitted, [5])
+        self.assertEqual(self.saved[-1], 6)
+
+    def test_shutdown_at_end_of_batch(self):
+        self.shutdown_after = 7
+        self.assertEqual(self.run_pass(), 7)
+        self.assertEqual(self.submitted, [5, 7])
+        self.assertEqual(self.saved[-1], 7)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,128 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import pdf_utils
+from pdf_utils import fill_template, html_to_latex, split_paragraphs
+
+
+class HtmlToLatexTest(unittest.TestCase):
+    def test_unordered_list(self):
+        self.assertEqual(
+            html_to_latex("<ul><li>one</li>\n <li><b>two</b></li></ul>"),
+            "\\begin{itemize}\n\\item one\n\\item \\textbf{two}\n\\end{itemize}",
+        )
+
+    def test_ordered_list(self):
+        self.assertEqual(
+            html_to_latex("<ol><li>a</li><li>b</li></ol>"),
+            "\\begin{enumerate}\n\\item a\n\\item b\n\\end{enumerate}",
+        )
+
+    def test_link_target_is_escaped(self):
+        self.assertEqual(
+            html_to_latex('<p>See <a href="https://x.org/a_b?q=1&amp;r=2">the docs</a>.</p>'),
+            "See \\href{https://x.org/a\\_b?q=1\\&r=2}{the docs}.",
+        )
+
+    def test_whitespace_between_elements_collapses(self):
+        self.assertEqual(html_to_latex("<p>one</p>   \n\n  <p>two</p>"), "one\n\ntwo")
+        self.assertEqual(
+            html_to_latex("<p>a <b>b</b>\n  <i>c</i></p>"), "a \\textbf{b}\n\\textit{c}"
+        )
+
+    def test_whitespace_in_pre_is_kept(self):
+        self.assertEqual(html_to_latex("<pre>a   b</pre>"), "a   b")
+
+    def test_repeated_line_breaks_become_paragraph_break(self):
+        self.assertEqual(html_to_latex("line<br><br><br>next"), "line\n\nnext")
+
+
+class SplitParagraphsTest(unittest.TestCase):
+    def test_crlf(self):
+        text = "Dear Sir,\r\n\r\nDate\r\n\r\nHello\r\n\r\nBody 50%\r\nmore\r\n\r\nEnd"
+        self.assertEqual(
+            split_paragraphs(text),
+            ("Dear Sir,", "Date", "Hello", "Body 50\\%\nmore\n\nEnd"),
+        )
+
+    def test_lone_cr_is_a_line_break(self):
+        self.assertEqual(split_paragraphs("a\rb\r\rc"), ("a\\\\b", "c", "", ""))
+
+    def test_other_line_boundaries(self):
+        # Everything str.splitlines() splits on, not just \n and \r.
+        self.assertEqual(split_paragraphs("a\u2028b"), ("a\\\\b", "", "", ""))
+        self.assertEqual(
+            split_paragraphs("a\x0bb\x0c\x0cc\x85\u2029d\x1c\x1d\x1ee"),
+            ("a\\\\b", "c", "d", "e"),
+        )
+
+    def test_blank_input(self):
+        self.assertEqual(split_paragraphs("  \r\n "), ("", "", "", ""))
+
+
+class FillTemplateTest(unittest.TestCase):
+    def test_placeholders(self):
+        template = (
+            "\\subject{{{SUBJECT}}} {{FIRST_PARAGRAPH}}|{{SECOND_PARAGRAPH}}"
+            "|{{THIRD_PARAGRAPH}}|{{BODY}}|{{OTHER}}"
+        )
+        self.assertEqual(
+            fill_template(template, "R&D 100%", "A", "B", "C", "D"),
+            "\\subject{R\\&D 100\\%} A|B|C|D|{{OTHER}}",
+        )
+
+    def test_placeholder_in_value_is_not_expanded(self):
+        self.assertEqual(
+            fill_template(
+                "{{FIRST_PARAGRAPH}}/{{SECOND_PARAGRAPH}}", "", "{{SECOND_PARAGRAPH}}", "x", "", ""
+            ),
+            "{{SECOND_PARAGRAPH}}/x",
+        )
+
+
+class StaleFormatTest(unittest.TestCase):
+    """A format pdflatex cannot load is dropped instead of being retried forever."""
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.fmt_path = os.path.join(tmp.name, "preamble-test.fmt")
+        open(self.fmt_path, "wb").close()
+        self.calls = []
+        for patcher in (
+            mock.patch.object(pdf_utils, "_FORMAT_DIR", tmp.name),
+            mock.patch.object(pdf_utils, "_FORMAT_BUILT", set()),
+            mock.patch.object(pdf_utils, "_FORMAT_FAILED", set()),
+            mock.patch.object(pdf_utils, "_preamble_format", self.preamble_format),
+            mock.patch.object(pdf_utils, "_typeset", self.typeset),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def preamble_format(self, latex_template):
+        return "preamble-test" if os.path.exists(self.fmt_path) else None
+
+    def typeset(self, tex_path, output_dir, fmt, two_pass):
+        # Only the run without the (stale) format produces a PDF.
+        self.calls.append(fmt)
+        if fmt is None:
+            with open(os.path.join(output_dir, "document.pdf"), "wb") as f:
+                f.write(b"%PDF")
+        return mock.Mock(returncode=0 if fmt is None else 1)
+
+    def test_stale_format_is_deleted(self):
+        self.assertEqual(pdf_utils._compile_latex("tpl", "doc"), b"%PDF")
+        self.assertFalse(os.path.exists(self.fmt_path))
+        self.assertEqual(pdf_utils._compile_latex("tpl", "doc"), b"%PDF")
+        self.assertEqual(self.calls, ["preamble-test", None, None])
+
+    def test_format_built_by_this_process_is_not_rebuilt(self):
+        pdf_utils._FORMAT_BUILT.add("preamble-test")
+        pdf_utils._compile_latex("tpl", "doc")
+        self.assertIn("preamble-test", pdf_utils._FORMAT_FAILED)
+
+
+if __name__ == "__main__":
+    unittest.main()
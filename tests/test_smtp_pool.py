@@ -0,0 +1,49 @@
+import unittest
+from unittest import mock
+
+from smtp_pool import SMTPPool
+
+
+class SMTPPoolTest(unittest.TestCase):
+    def setUp(self):
+        patcher = mock.patch("smtp_pool.smtplib.SMTP")
+        self.smtp_class = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.smtp_class.return_value.noop.return_value = (250, b"OK")
+
+    def pool(self, **kwargs):
+        return SMTPPool("smtp.example.org", 587, "user", "secret", **kwargs)
+
+    def send(self, pool, count=1):
+        for _ in range(count):
+            with pool.acquire() as conn:
+                conn.send_message("msg")
+
+    def test_sequential_sends_reuse_one_session(self):
+        self.send(self.pool(size=5), 6)
+        self.assertEqual(self.smtp_class.call_count, 1)
+        self.smtp_class.return_value.login.assert_called_once_with("user", "secret")
+
+    def test_session_recycled_after_max_messages(self):
+        self.send(self.pool(size=1, max_messages=2), 5)
+        self.assertEqual(self.smtp_class.call_count, 3)
+
+    def test_dead_session_reconnects(self):
+        pool = self.pool(size=1)
+        self.send(pool)
+        self.smtp_class.return_value.noop.side_effect = OSError("connection reset")
+        self.send(pool)
+        self.assertEqual(self.smtp_class.call_count, 2)
+
+    def test_failed_send_closes_session(self):
+        pool = self.pool(size=1)
+        self.smtp_class.return_value.send_message.side_effect = OSError("broken pipe")
+        with self.assertRaises(OSError):
+            self.send(pool)
+        self.smtp_class.return_value.send_message.side_effect = None
+        self.send(pool)
+        self.assertEqual(self.smtp_class.call_count, 2)
+
+
+if __name__ == "__main__":
+    unittest.main()